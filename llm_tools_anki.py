@@ -1,8 +1,624 @@
+import base64
+import csv
+import fnmatch
+import hashlib
+import html
+import io
 import json
+import math
+import multiprocessing
+import os
+import pathlib
+import re
+import statistics
 import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import llm
 import httpx
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+if orjson is not None:
+    _fast_loads = orjson.loads
+
+    def _fast_dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+elif msgspec is not None:
+    _fast_loads = msgspec.json.decode
+
+    def _fast_dumps(obj) -> str:
+        return msgspec.json.encode(obj).decode("utf-8")
+
+else:
+    _fast_loads = None
+    _fast_dumps = None
+
+
+def _loads(response: httpx.Response):
+    """Decode a JSON response body, using orjson or msgspec when installed."""
+    if _fast_loads is not None:
+        return _fast_loads(response.content)
+    return response.json()
+
+
+def _dumps(obj) -> str:
+    """
+    Encode obj as compact JSON, using orjson or msgspec when installed.
+
+    The output is the same with every backend: no whitespace and non-ASCII characters
+    kept as-is.
+    """
+    if _fast_dumps is not None:
+        return _fast_dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+def _chunks(items: list, size: int):
+    """Yield successive slices of ``items`` with at most ``size`` elements."""
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def _has_media(value: str, media_type: str) -> bool:
+    """Return True if a field value already contains media of the given type."""
+    if media_type == "audio":
+        return "<audio" in value or "[sound:" in value
+    return "<img" in value
+
+
+_TAG_RE = re.compile(r"<[^>]+>")
+_MEDIA_TAG_RE = re.compile(r"<(audio|img)\b[^>]*>", re.IGNORECASE)
+_WHITESPACE_RE = re.compile(r"\s+")
+_SOUND_TAG_RE = re.compile(r"\[sound:[^\]]*\]")
+
+
+def _strip_html(value: str) -> str:
+    """Reduce an HTML field value to plain text, keeping a marker for embedded media."""
+    value = _MEDIA_TAG_RE.sub(lambda m: f"[{m.group(1).lower()}]", value)
+    value = html.unescape(_TAG_RE.sub(" ", value))
+    return _WHITESPACE_RE.sub(" ", value).strip()
+
+
+def _hash_file(path: str) -> str:
+    """Return the SHA-1 hex digest of a file's contents."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _try_hash_file(path: str) -> tuple:
+    """Return (digest, None) for a file, or (None, error message) if it cannot be read."""
+    try:
+        return _hash_file(path), None
+    except OSError as e:
+        return None, str(e)
+
+
+_MEDIA_MANIFEST_NAME = ".anki_media_manifest.json"
+# Fewer changed files than this are hashed in-process; starting workers costs more
+_PROCESS_HASH_MIN_FILES = 32
+
+
+_OUTPUT_FORMATS = ("json", "compact", "table")
+
+# (label, lowest interval in days, highest interval in days)
+_INTERVAL_BUCKETS = (
+    ("new/learning", None, 0),
+    ("1d", 1, 1),
+    ("2-7d", 2, 7),
+    ("8-21d", 8, 21),
+    ("22-90d", 22, 90),
+    ("91-365d", 91, 365),
+    (">1y", 366, None),
+)
+
+
+class Note:
+    """
+    A note decoded from a notesInfo entry.
+
+    Field objects are flattened to {name: value} in field order. Using __slots__ keeps
+    bulk reads of thousands of notes considerably smaller than the nested response dicts.
+    """
+
+    __slots__ = ("note_id", "model_name", "tags", "fields", "mod")
+
+    def __init__(
+        self,
+        note_id: int,
+        model_name: str,
+        tags: list,
+        fields: dict,
+        mod: int = None,
+    ):
+        self.note_id = note_id
+        self.model_name = model_name
+        self.tags = tags
+        self.fields = fields
+        self.mod = mod
+
+    @classmethod
+    def from_info(cls, info: dict) -> "Note":
+        """Build a Note from a notesInfo entry."""
+        ordered = sorted(
+            info.get("fields", {}).items(), key=lambda kv: kv[1].get("order", 0)
+        )
+        return cls(
+            note_id=info.get("noteId"),
+            model_name=info.get("modelName", ""),
+            tags=info.get("tags", []),
+            fields={name: field.get("value", "") for name, field in ordered},
+            mod=info.get("mod"),
+        )
+
+
+class Card:
+    """
+    The scheduling details of a card decoded from a cardsInfo entry.
+
+    Question and answer HTML, CSS and field contents are dropped, so cached cards stay small.
+    """
+
+    __slots__ = (
+        "card_id",
+        "note_id",
+        "deck_name",
+        "model_name",
+        "interval",
+        "factor",
+        "lapses",
+        "reps",
+        "queue",
+        "type",
+        "mod",
+    )
+
+    def __init__(
+        self,
+        card_id: int,
+        note_id: int,
+        deck_name: str = "",
+        model_name: str = "",
+        interval: int = 0,
+        factor: int = 0,
+        lapses: int = 0,
+        reps: int = 0,
+        queue: int = 0,
+        type: int = 0,
+        mod: int = None,
+    ):
+        self.card_id = card_id
+        self.note_id = note_id
+        self.deck_name = deck_name
+        self.model_name = model_name
+        self.interval = interval
+        self.factor = factor
+        self.lapses = lapses
+        self.reps = reps
+        self.queue = queue
+        self.type = type
+        self.mod = mod
+
+    @classmethod
+    def from_info(cls, info: dict) -> "Card":
+        """Build a Card from a cardsInfo entry."""
+        return cls(
+            card_id=info.get("cardId"),
+            note_id=info.get("note"),
+            deck_name=info.get("deckName", ""),
+            model_name=info.get("modelName", ""),
+            interval=info.get("interval", 0),
+            factor=info.get("factor", 0),
+            lapses=info.get("lapses", 0),
+            reps=info.get("reps", 0),
+            queue=info.get("queue", 0),
+            type=info.get("type", 0),
+            mod=info.get("mod"),
+        )
+
+    @property
+    def ease(self):
+        """The ease factor as a multiplier (e.g. 2.5), or None for new cards."""
+        return self.factor / 1000 if self.factor else None
+
+    def summary(self) -> dict:
+        """Return the identifying and scheduling details reported by the analytics tools."""
+        return {
+            "cardId": self.card_id,
+            "note": self.note_id,
+            "deckName": self.deck_name,
+            "lapses": self.lapses,
+            "ease": self.ease,
+            "interval": self.interval,
+        }
+
+
+def _flatten(item, strip_html: bool = False, flatten: bool = True):
+    """
+    Flatten AnkiConnect field objects in a result.
+
+    Field maps such as {"Front": {"value": "...", "order": 0}} become {"Front": "..."},
+    in field order. With strip_html the HTML is removed from the field values; other
+    strings such as tags and deck names are left as they are. With flatten=False only
+    the HTML is stripped and the field objects keep their shape.
+    """
+    if isinstance(item, list):
+        return [_flatten(value, strip_html, flatten) for value in item]
+    if not isinstance(item, dict):
+        return item
+
+    result = {}
+    for key, value in item.items():
+        if (
+            key == "fields"
+            and isinstance(value, dict)
+            and all(isinstance(v, dict) and "value" in v for v in value.values())
+        ):
+            if flatten:
+                ordered = sorted(value.items(), key=lambda kv: kv[1].get("order", 0))
+                value = {name: field["value"] for name, field in ordered}
+                if strip_html:
+                    value = {name: _strip_html(v or "") for name, v in value.items()}
+            elif strip_html:
+                value = {
+                    name: {**field, "value": _strip_html(field["value"] or "")}
+                    for name, field in value.items()
+                }
+            result[key] = value
+        else:
+            result[key] = _flatten(value, strip_html, flatten)
+    return result
+
+
+def _to_table(result) -> str:
+    """Render a result as CSV, one row per item, with flattened fields as columns."""
+    if isinstance(result, dict):
+        rows = [{"key": key, "value": value} for key, value in result.items()]
+    elif isinstance(result, list):
+        rows = [item if isinstance(item, dict) else {"value": item} for item in result]
+    else:
+        rows = [{"value": result}]
+
+    columns = []
+    flat_rows = []
+    for row in rows:
+        flat_row = {}
+        for key, value in row.items():
+            if key == "fields" and isinstance(value, dict):
+                flat_row.update(value)
+                continue
+            if key == "tags" and isinstance(value, list):
+                value = " ".join(value)
+            elif isinstance(value, (dict, list)):
+                value = _dumps(value)
+            flat_row[key] = value
+        for key in flat_row:
+            if key not in columns:
+                columns.append(key)
+        flat_rows.append(flat_row)
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(flat_rows)
+    return buffer.getvalue()
+
+
+def _validate_format_args(output_format: str, limit: int, offset: int) -> None:
+    """Raise ValueError for output arguments _format_result cannot honour."""
+    if output_format not in _OUTPUT_FORMATS:
+        raise ValueError(f"output_format must be one of {', '.join(_OUTPUT_FORMATS)}")
+    if limit is not None and limit < 1:
+        raise ValueError("limit must be at least 1")
+    if offset < 0:
+        raise ValueError("offset must not be negative")
+
+
+def _format_result(
+    result,
+    output_format: str = "json",
+    strip_html: bool = False,
+    limit: int = None,
+    offset: int = 0,
+) -> str:
+    """
+    Encode an AnkiConnect result for the LLM.
+
+    Args:
+        result: The decoded AnkiConnect result.
+        output_format (str): "json" returns the result unchanged, "compact" flattens field
+            objects and drops whitespace, "table" renders CSV rows.
+        strip_html (bool): Replace HTML in note field values with plain text.
+        limit (int, optional): Return at most this many items of a list result. Must be
+            at least 1.
+        offset (int): Index of the first list item to return. Must not be negative.
+
+    Returns:
+        str: The encoded result. When a list is truncated, a continuation handle with the
+             offset to pass on the next call is included.
+    """
+    _validate_format_args(output_format, limit, offset)
+
+    if output_format == "json" and not strip_html and limit is None and not offset:
+        return json.dumps(result)
+
+    continuation = None
+    if isinstance(result, list) and (limit is not None or offset):
+        total = len(result)
+        end = total if limit is None else offset + limit
+        result = result[offset:end]
+        if end < total:
+            continuation = {"next_offset": end, "total": total}
+
+    if output_format != "json" or strip_html:
+        result = _flatten(result, strip_html, flatten=output_format != "json")
+
+    if output_format == "table":
+        table = _to_table(result)
+        if continuation:
+            table += f"# more: next_offset={continuation['next_offset']} total={continuation['total']}\n"
+        return table
+
+    if continuation:
+        result = {"items": result, **continuation}
+    if output_format == "compact":
+        return _dumps(result)
+    return json.dumps(result)
+
+
+# Texts longer than this are split into sentences, and longer sentences at whitespace
+_TTS_CHUNK_CHARS = 400
+# Most TTS requests in flight at once per toolbox, however calls are nested
+_TTS_MAX_CONCURRENCY = 8
+# Default size bound of the on-disk TTS chunk cache in megabytes
+_TTS_CACHE_MB = 100
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?;。！？])\s+")
+
+
+def _split_sentences(text: str, max_chars: int = _TTS_CHUNK_CHARS) -> list:
+    """
+    Split text into one chunk per sentence for speech synthesis.
+
+    Sentences longer than max_chars are split at whitespace. Chunk boundaries depend
+    only on each sentence's own text, so editing one sentence leaves the other chunks,
+    and their cached audio, unchanged.
+    """
+    chunks = []
+    for sentence in _SENTENCE_END_RE.split(text.strip()):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            chunks.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            chunks.append(sentence)
+    return chunks
+
+
+def _concat_audio(segments: list) -> bytes:
+    """Join audio segments, merging WAV segments into a single WAV file."""
+    if not all(segment[:4] == b"RIFF" for segment in segments):
+        return b"".join(segments)
+    output = io.BytesIO()
+    with wave.open(output, "wb") as writer:
+        for index, segment in enumerate(segments):
+            with wave.open(io.BytesIO(segment), "rb") as reader:
+                if index == 0:
+                    writer.setparams(reader.getparams())
+                writer.writeframes(reader.readframes(reader.getnframes()))
+    return output.getvalue()
+
+
+_SECTION_RE = re.compile(
+    r"\{\{([#^])\s*([^}]+?)\s*\}\}(.*?)\{\{/\s*\2\s*\}\}", re.DOTALL
+)
+_FIELD_TAG_RE = re.compile(r"\{\{\s*([^#^/{}][^{}]*?)\s*\}\}")
+_CLOZE_RE = re.compile(r"\{\{c(\d+)::(.*?)(?:::(.*?))?\}\}", re.DOTALL)
+_DATA_URI_RE = re.compile(r"data:[\w/+.-]+;base64,([A-Za-z0-9+/=]+)")
+
+
+def _cloze_numbers(value: str) -> list:
+    """Return the sorted cloze numbers used in a field value."""
+    return sorted({int(number) for number, _, _ in _CLOZE_RE.findall(value or "")})
+
+
+def _render_cloze(value: str, ordinal: int, question: bool) -> str:
+    """Render cloze deletions, hiding deletion ``ordinal`` on the question side."""
+
+    def replace(match):
+        number, text, hint = match.groups()
+        if int(number) != ordinal:
+            return text
+        if question:
+            return f'<span class="cloze">[{hint or "..."}]</span>'
+        return f'<span class="cloze">{text}</span>'
+
+    return _CLOZE_RE.sub(replace, value or "")
+
+
+def _render_template(
+    template: str,
+    fields: dict,
+    front_side: str = "",
+    cloze: int = None,
+    question: bool = True,
+):
+    """
+    Render an Anki card template locally.
+
+    Supports field replacements, {{#Field}}/{{^Field}} sections, {{FrontSide}} and the
+    text, cloze and type filters; other filters are ignored.
+
+    Returns:
+        tuple: The rendered HTML and whether any non-empty field was substituted.
+    """
+
+    def nonblank(name):
+        return bool(_strip_html(fields.get(name) or ""))
+
+    previous = None
+    while previous != template:
+        previous = template
+        template = _SECTION_RE.sub(
+            lambda m: (
+                m.group(3) if nonblank(m.group(2)) == (m.group(1) == "#") else ""
+            ),
+            template,
+        )
+
+    used_nonempty = False
+
+    def replace(match):
+        nonlocal used_nonempty
+        *filters, name = [part.strip() for part in match.group(1).split(":")]
+        if name == "FrontSide":
+            return front_side
+        value = fields.get(name) or ""
+        if "type" in filters:
+            return "[type answer]"
+        if "cloze" in filters:
+            if cloze in _cloze_numbers(value):
+                used_nonempty = True
+            return _render_cloze(value, cloze, question)
+        if "text" in filters:
+            value = _strip_html(value)
+        if _strip_html(value):
+            used_nonempty = True
+        return value
+
+    return _FIELD_TAG_RE.sub(replace, template), used_nonempty
+
+
+def _service(url: str) -> str:
+    """Name the external service a request URL belongs to."""
+    if "texttospeech.googleapis.com" in url:
+        return "tts"
+    if "unsplash.com" in url:
+        return "unsplash"
+    return "ankiconnect"
+
+
+def _traffic_key(method: str, url: str, body) -> tuple:
+    """Key used to match a request against recorded traffic."""
+    return (method, url, json.dumps(body, sort_keys=True))
+
+
+class TrafficRecorder:
+    """
+    Append every HTTP request made by an Anki toolbox, with its response, to a JSONL file.
+
+    Each line records the service ("ankiconnect", "tts" or "unsplash"), method, full URL,
+    JSON body, status code, response body and elapsed time. Request headers are not
+    recorded, so API keys do not end up in the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        request: httpx.Request,
+        response: httpx.Response = None,
+        elapsed: float = 0.0,
+        error: Exception = None,
+    ):
+        """Append one request/response pair to the recording."""
+        entry = {
+            "timestamp": time.time(),
+            "service": _service(str(request.url)),
+            "method": request.method,
+            "url": str(request.url),
+            "body": json.loads(request.content) if request.content else None,
+            "elapsed_ms": round(elapsed * 1000, 3),
+        }
+        if error is not None:
+            entry["error"] = str(error)
+        else:
+            entry["status_code"] = response.status_code
+            try:
+                entry["response"] = json.loads(response.content)
+            except ValueError:
+                entry["text"] = response.text
+        line = json.dumps(entry)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+class ReplayTransport(httpx.BaseTransport):
+    """
+    An httpx transport serving responses from a TrafficRecorder file.
+
+    Requests are matched on method, URL and JSON body. Identical requests are answered with
+    their recorded responses in the order they were recorded, and the last one is reused
+    once they run out, so a session replays deterministically without network access.
+    Recorded transport errors are raised again.
+
+    Args:
+        path (str): Path of the JSONL recording.
+        simulate_latency (bool): Sleep for each recorded elapsed time before responding, to
+            reproduce the original session's timing. Defaults to False.
+    """
+
+    def __init__(self, path: str, simulate_latency: bool = False):
+        self.simulate_latency = simulate_latency
+        self._entries = {}
+        self._lock = threading.Lock()
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                key = _traffic_key(entry["method"], entry["url"], entry["body"])
+                self._entries.setdefault(key, []).append(entry)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content) if request.content else None
+        key = _traffic_key(request.method, str(request.url), body)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise httpx.TransportError(
+                    f"No recorded response for {request.method} {request.url}",
+                    request=request,
+                )
+            entry = entries.pop(0) if len(entries) > 1 else entries[0]
+        if self.simulate_latency:
+            time.sleep(entry["elapsed_ms"] / 1000)
+        if "error" in entry:
+            raise httpx.TransportError(entry["error"], request=request)
+        if "response" in entry:
+            return httpx.Response(
+                entry["status_code"], json=entry["response"], request=request
+            )
+        return httpx.Response(
+            entry["status_code"], text=entry.get("text", ""), request=request
+        )
+
 
 class Anki(llm.Toolbox):
     """
@@ -16,19 +632,46 @@ class Anki(llm.Toolbox):
     temporary HTML files that can be referenced when creating notes.
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        record_file: str = None,
+        replay_file: str = None,
+        tts_cache_mb: int = _TTS_CACHE_MB,
+    ):
         """
         Initialize the Anki toolbox with the default AnkiConnect URL.
 
         Sets up the connection URL to the local AnkiConnect instance.
+
+        Args:
+            record_file (str, optional): Append every AnkiConnect, TTS and Unsplash request
+                and response, with timings, to this JSONL file.
+            replay_file (str, optional): Serve all requests from a file written with
+                record_file instead of the network, to re-run a session offline.
+            tts_cache_mb (int): Size bound of the on-disk cache of synthesized speech in
+                the llm user directory. The least recently used audio is evicted first.
+                Set to 0 to disable the cache. Defaults to 100.
         """
         self.url = "http://localhost:8765"
+        self._recorder = TrafficRecorder(record_file) if record_file else None
+        self._replay = ReplayTransport(replay_file) if replay_file else None
         self.unsplash_access_key = llm.get_key(
             explicit_key="unsplash", key_alias="unsplash", env_var="UNSPLASH_ACCESS_KEY"
         )
         self.gemini_api_key = llm.get_key(
             explicit_key="gemini", key_alias="gemini", env_var="GEMINI_API_KEY"
         )
+        # Card ID -> (modification time, Card), see _cards_info
+        self._card_cache = {}
+        # Model name -> field names and card templates, see _model_info
+        self._model_cache = {}
+        # Synthesized chunks are cached on disk across sessions, see _synthesize_chunk
+        self._tts_cache_dir = llm.user_dir() / "anki-tts-cache"
+        self._tts_cache_max_bytes = tts_cache_mb * 1024 * 1024
+        # Total size of the cache directory, scanned on the first write
+        self._tts_cache_bytes = None
+        self._tts_cache_lock = threading.Lock()
+        self._tts_slots = threading.BoundedSemaphore(_TTS_MAX_CONCURRENCY)
 
     def get_image_url(self, query: str) -> str:
         """
@@ -56,7 +699,8 @@ class Anki(llm.Toolbox):
 
             params = {"query": query, "per_page": 1, "orientation": "landscape"}
 
-            response = httpx.get(
+            response = self._send(
+                "GET",
                 "https://api.unsplash.com/photos/random",
                 headers=headers,
                 params=params,
@@ -76,13 +720,29 @@ class Anki(llm.Toolbox):
             # Fallback to the old method if API call fails
             return f"https://source.unsplash.com/random/400x300/?{query}"
 
-    def query(self, request: str) -> str:
+    def query(
+        self,
+        request: str,
+        output_format: str = "json",
+        strip_html: bool = False,
+        limit: int = None,
+        offset: int = 0,
+    ) -> str:
         """
               Send a query to the AnkiConnect API.
 
               Args:
                   request (str): A JSON string containing the API request parameters.
                                 Should include 'action' and other required fields.
+                  output_format (str): "json" (default) returns the raw result, "compact"
+                                flattens note fields to {"Field": "value"} and drops
+                                whitespace, "table" returns CSV rows. Use compact or table
+                                for large results.
+                  strip_html (bool): Replace HTML in field values with plain text. Embedded
+                                audio and images are shown as [audio] and [img].
+                  limit (int, optional): Return at most this many items of a list result.
+                                The response then includes next_offset for the next page.
+                  offset (int): Index of the first list item to return.
 
               Returns:
                   str: JSON string containing the API response result, or error message
@@ -111,20 +771,73 @@ class Anki(llm.Toolbox):
         ```
         """
         try:
+            # Reject bad output arguments before the action runs, so a retry after the
+            # error cannot repeat a write
+            _validate_format_args(output_format, limit, offset)
             body = json.loads(request)
-            response = httpx.post(f"{self.url}/", json=body)
+            response = self._send("POST", f"{self.url}/", json=body)
             response.raise_for_status()
-            result = response.json()
+            result = _loads(response)
             if result.get("error"):
                 err_msg = (
                     "There was an error. If you want to check the docs, use the Anki_docs tool. "
                     f"This was the error message: {result.get('error')}"
                 )
                 return err_msg
-            return json.dumps(result.get("result", {}))
+            return _format_result(
+                result.get("result", {}), output_format, strip_html, limit, offset
+            )
         except Exception as ex:
             return f"Error: {ex}"
 
+    def _send(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        Send an HTTP request, recording or replaying it when configured.
+
+        All network access of the toolbox goes through here.
+        """
+        request = None
+        if self._recorder is not None or self._replay is not None:
+            request = httpx.Request(
+                method, url, json=kwargs.get("json"), params=kwargs.get("params")
+            )
+        if self._replay is not None:
+            return self._replay.handle_request(request)
+
+        send = httpx.post if method == "POST" else httpx.get
+        start = time.perf_counter()
+        try:
+            response = send(url, **kwargs)
+        except Exception as e:
+            if self._recorder is not None:
+                self._recorder.record(
+                    request, elapsed=time.perf_counter() - start, error=e
+                )
+            raise
+        if self._recorder is not None:
+            self._recorder.record(request, response, time.perf_counter() - start)
+        return response
+
+    def _invoke(self, action: str, params: dict = None):
+        """
+        Call an AnkiConnect action and return its raw result.
+
+        Unlike query, this is meant for use inside other tools: the decoded result is
+        returned as-is and AnkiConnect errors are raised instead of being formatted.
+
+        Raises:
+            RuntimeError: If AnkiConnect reports an error for the action.
+        """
+        body = {"action": action, "version": 5}
+        if params is not None:
+            body["params"] = params
+        response = self._send("POST", f"{self.url}/", json=body)
+        response.raise_for_status()
+        result = _loads(response)
+        if result.get("error"):
+            raise RuntimeError(result.get("error"))
+        return result.get("result")
+
     def add_note(
         self,
         deck_name: str,
@@ -258,12 +971,24 @@ class Anki(llm.Toolbox):
 
         return self.query(json.dumps(request))
 
-    def find_notes(self, query: str) -> str:
+    def find_notes(
+        self,
+        query: str,
+        output_format: str = "json",
+        strip_html: bool = False,
+        limit: int = None,
+        offset: int = 0,
+    ) -> str:
         """
         Find notes using a search query.
 
         Args:
             query (str): Search query (same syntax as Anki's browse function)
+            output_format (str): "json" (default), "compact" or "table". See query.
+            strip_html (bool): Replace HTML in field values with plain text.
+            limit (int, optional): Return at most this many items; the response then
+                includes next_offset for fetching the next page.
+            offset (int): Index of the first item to return.
 
         Returns:
             str: JSON string containing array of note IDs, or error message
@@ -273,17 +998,30 @@ class Anki(llm.Toolbox):
             >>> result = anki.find_notes("deck:current")
             >>> result = anki.find_notes("tag:important")
             >>> result = anki.find_notes("front:hello")
+            >>> result = anki.find_notes("deck:Spanish", limit=100)
         """
         request = {"action": "findNotes", "version": 5, "params": {"query": query}}
 
-        return self.query(json.dumps(request))
+        return self.query(json.dumps(request), output_format, strip_html, limit, offset)
 
-    def get_notes_info(self, note_ids: list) -> str:
+    def get_notes_info(
+        self,
+        note_ids: list,
+        output_format: str = "json",
+        strip_html: bool = False,
+        limit: int = None,
+        offset: int = 0,
+    ) -> str:
         """
         Get detailed information about notes.
 
         Args:
             note_ids (list): List of note IDs to get information for
+            output_format (str): "json" (default), "compact" or "table". See query.
+            strip_html (bool): Replace HTML in field values with plain text.
+            limit (int, optional): Return at most this many items; the response then
+                includes next_offset for fetching the next page.
+            offset (int): Index of the first item to return.
 
         Returns:
             str: JSON string containing note information, or error message
@@ -291,15 +1029,30 @@ class Anki(llm.Toolbox):
         Example:
             >>> anki = Anki()
             >>> result = anki.get_notes_info([1502298033753, 1502298036657])
+            >>> # Flattened fields as CSV rows, without HTML
+            >>> result = anki.get_notes_info(
+            ...     [1502298033753, 1502298036657], output_format="table", strip_html=True
+            ... )
         """
         request = {"action": "notesInfo", "version": 5, "params": {"notes": note_ids}}
 
-        return self.query(json.dumps(request))
+        return self.query(json.dumps(request), output_format, strip_html, limit, offset)
 
-    def get_deck_names(self) -> str:
+    def get_deck_names(
+        self,
+        output_format: str = "json",
+        limit: int = None,
+        offset: int = 0,
+    ) -> str:
         """
         Get all deck names.
 
+        Args:
+            output_format (str): "json" (default), "compact" or "table". See query.
+            limit (int, optional): Return at most this many items; the response then
+                includes next_offset for fetching the next page.
+            offset (int): Index of the first item to return.
+
         Returns:
             str: JSON string containing array of deck names, or error message
 
@@ -309,12 +1062,17 @@ class Anki(llm.Toolbox):
         """
         request = {"action": "deckNames", "version": 5}
 
-        return self.query(json.dumps(request))
+        return self.query(
+            json.dumps(request), output_format, limit=limit, offset=offset
+        )
 
-    def get_deck_names_and_ids(self) -> str:
+    def get_deck_names_and_ids(self, output_format: str = "json") -> str:
         """
         Get all deck names and their IDs.
 
+        Args:
+            output_format (str): "json" (default), "compact" or "table". See query.
+
         Returns:
             str: JSON string containing dictionary of deck names and IDs, or error message
 
@@ -324,7 +1082,7 @@ class Anki(llm.Toolbox):
         """
         request = {"action": "deckNamesAndIds", "version": 5}
 
-        return self.query(json.dumps(request))
+        return self.query(json.dumps(request), output_format)
 
     def get_deck_config(self, deck_name: str) -> str:
         """
@@ -348,6 +1106,555 @@ class Anki(llm.Toolbox):
 
         return self.query(json.dumps(request))
 
+    def _cards_info(self, card_ids: list, batch_size: int = 500) -> list:
+        """
+        Fetch Card objects for card_ids, reusing cached cards that have not changed.
+
+        Card modification times are checked with the lightweight cardsModTime action and
+        only new or modified cards are re-read with cardsInfo. AnkiConnect versions without
+        cardsModTime fall back to reading every card.
+        """
+        try:
+            mod_times = {}
+            for batch in _chunks(card_ids, batch_size):
+                for entry in self._invoke("cardsModTime", {"cards": batch}):
+                    mod_times[entry["cardId"]] = entry["mod"]
+        except Exception:
+            mod_times = {}
+
+        stale = [
+            card_id
+            for card_id in card_ids
+            if card_id not in mod_times
+            or self._card_cache.get(card_id, (None,))[0] != mod_times[card_id]
+        ]
+        for batch in _chunks(stale, batch_size):
+            for info in self._invoke("cardsInfo", {"cards": batch}):
+                if not info:
+                    continue
+                card = Card.from_info(info)
+                self._card_cache[card.card_id] = (
+                    mod_times.get(card.card_id, card.mod),
+                    card,
+                )
+
+        return [
+            self._card_cache[card_id][1]
+            for card_id in card_ids
+            if card_id in self._card_cache
+        ]
+
+    def card_stats(self, query: str, leech_lapses: int = 8, top: int = 10) -> str:
+        """
+        Summarise review statistics for the cards matching a search query.
+
+        Card data is fetched in bulk and aggregated locally, so even large decks are
+        answered in a single tool call with a small summary. Card details are cached between
+        calls and only re-read for cards that changed since the last call.
+
+        Args:
+            query (str): Search query selecting the cards (e.g. "deck:Spanish").
+            leech_lapses (int): Lapse count at or above which a card counts as a leech.
+                Defaults to 8, Anki's default leech threshold.
+            top (int): Number of cards listed in each outlier list. Defaults to 10.
+
+        Returns:
+            str: JSON string with card and due counts, the interval distribution, ease and
+                 lapse statistics, the worst lapse and ease outliers, and a per-deck breakdown
+                 including an estimated retention (1 - lapses / reviews), or an error message.
+
+        Example:
+            >>> anki = Anki()
+            >>> result = anki.card_stats("deck:Spanish")
+            >>> result = anki.card_stats("deck:Spanish is:review", leech_lapses=5)
+        """
+        try:
+            card_ids = self._invoke("findCards", {"query": query})
+            cards = self._cards_info(card_ids)
+            due_flags = []
+            for batch in _chunks(card_ids, 500):
+                due_flags.extend(self._invoke("areDue", {"cards": batch}))
+        except Exception as e:
+            return f"Error: {e}"
+
+        due = {card_id for card_id, flag in zip(card_ids, due_flags) if flag}
+        intervals = [card.interval for card in cards]
+        eases = [card.ease for card in cards if card.factor]
+        lapses = [card.lapses for card in cards]
+
+        distribution = {}
+        for label, low, high in _INTERVAL_BUCKETS:
+            distribution[label] = sum(
+                1
+                for interval in intervals
+                if (low is None or interval >= low)
+                and (high is None or interval <= high)
+            )
+
+        decks = {}
+        for card in cards:
+            deck = decks.setdefault(
+                card.deck_name,
+                {"cards": 0, "due": 0, "mature": 0, "lapses": 0, "reviews": 0},
+            )
+            deck["cards"] += 1
+            deck["due"] += card.card_id in due
+            deck["mature"] += card.interval >= 21
+            deck["lapses"] += card.lapses
+            deck["reviews"] += card.reps
+        for deck in decks.values():
+            deck["retention_estimate"] = (
+                round(1 - deck["lapses"] / deck["reviews"], 3)
+                if deck["reviews"]
+                else None
+            )
+
+        most_lapses = sorted(cards, key=lambda c: c.lapses, reverse=True)
+        lowest_ease = sorted(
+            (card for card in cards if card.factor), key=lambda c: c.factor
+        )
+
+        summary = {
+            "cards": len(cards),
+            "due": len(due),
+            "suspended": sum(1 for card in cards if card.queue == -1),
+            "leeches": sum(1 for value in lapses if value >= leech_lapses),
+            "interval_distribution": distribution,
+            "interval_median": statistics.median(intervals) if intervals else None,
+            "ease_mean": round(statistics.mean(eases), 3) if eases else None,
+            "ease_median": statistics.median(eases) if eases else None,
+            "lapses_total": sum(lapses),
+            "most_lapses": [
+                card.summary() for card in most_lapses[:top] if card.lapses
+            ],
+            "lowest_ease": [card.summary() for card in lowest_ease[:top]],
+            "decks": decks,
+        }
+        return _dumps(summary)
+
+    def find_leeches(self, query: str, min_lapses: int = 8) -> str:
+        """
+        Find leech cards: cards that have lapsed at least min_lapses times.
+
+        Args:
+            query (str): Search query selecting the cards (e.g. "deck:Spanish").
+            min_lapses (int): Minimum number of lapses. Defaults to 8.
+
+        Returns:
+            str: JSON string containing a list of {cardId, note, deckName, lapses, ease,
+                 interval}, worst first, or an error message.
+
+        Example:
+            >>> anki = Anki()
+            >>> result = anki.find_leeches("deck:Spanish", min_lapses=5)
+        """
+        try:
+            cards = self._cards_info(self._invoke("findCards", {"query": query}))
+        except Exception as e:
+            return f"Error: {e}"
+
+        leeches = sorted(
+            (card for card in cards if card.lapses >= min_lapses),
+            key=lambda c: c.lapses,
+            reverse=True,
+        )
+        return _dumps([card.summary() for card in leeches])
+
+    def _model_info(self, model_name: str) -> dict:
+        """
+        Fetch and cache a model's field names and card templates.
+
+        Templates come from the modelTemplates action. AnkiConnect versions without it fall
+        back to templates built from modelFieldsOnTemplates, which list the fields shown on
+        each side of every card.
+        """
+        if model_name not in self._model_cache:
+            field_names = self._invoke("modelFieldNames", {"modelName": model_name})
+            try:
+                templates = self._invoke("modelTemplates", {"modelName": model_name})
+            except RuntimeError:
+                on_templates = self._invoke(
+                    "modelFieldsOnTemplates", {"modelName": model_name}
+                )
+                templates = {
+                    name: {
+                        "Front": "<br>".join(f"{{{{{f}}}}}" for f in front),
+                        "Back": "{{FrontSide}}<hr id=answer>"
+                        + "<br>".join(f"{{{{{f}}}}}" for f in back),
+                    }
+                    for name, (front, back) in on_templates.items()
+                }
+            self._model_cache[model_name] = {
+                "fields": field_names,
+                "templates": templates,
+            }
+        return self._model_cache[model_name]
+
+    def preview_notes(
+        self,
+        notes: list,
+        include_html: bool = True,
+        max_media_bytes: int = 1000000,
+    ) -> str:
+        """
+        Render candidate notes locally and report problems before adding them.
+
+        Takes the same note dictionaries as add_notes. Each model's fields and templates are
+        fetched once and cached, after which all rendering happens in-process. Use this to
+        check a batch of generated notes, then call add_notes with the notes that passed.
+
+        Problems reported per note:
+            - unknown_model: the model could not be loaded.
+            - missing_fields: model fields not given in the note.
+            - unknown_fields: note fields that the model does not have.
+            - empty_cards: card templates whose front side would be empty, so Anki would
+              not create the card.
+            - no_cards: none of the model's cards would be created.
+            - oversized_media: embedded base64 media larger than max_media_bytes.
+
+        Args:
+            notes (list): List of note dictionaries with modelName and fields.
+            include_html (bool): Include the rendered question and answer HTML of each card,
+                with embedded base64 data elided. Defaults to True.
+            max_media_bytes (int): Largest allowed decoded size of an embedded media file.
+                Defaults to 1,000,000.
+
+        Returns:
+            str: JSON string with one entry per note ({index, ok, problems, cards}), or an
+                 error message.
+
+        Example:
+            >>> anki = Anki()
+            >>> notes = [
+            ...     {
+            ...         "deckName": "Default",
+            ...         "modelName": "Basic (and reversed card)",
+            ...         "fields": {"Front": "hola", "Back": "hello"},
+            ...     }
+            ... ]
+            >>> result = anki.preview_notes(notes)
+        """
+        previews = []
+        for index, note in enumerate(notes):
+            fields = note.get("fields", {})
+            problems = []
+            preview = {"index": index, "ok": True, "problems": problems}
+            previews.append(preview)
+            try:
+                model = self._model_info(note.get("modelName", ""))
+            except Exception as e:
+                problems.append({"type": "unknown_model", "detail": str(e)})
+                preview["ok"] = False
+                continue
+
+            missing = [name for name in model["fields"] if name not in fields]
+            if missing:
+                problems.append({"type": "missing_fields", "fields": missing})
+            unknown = [name for name in fields if name not in model["fields"]]
+            if unknown:
+                problems.append({"type": "unknown_fields", "fields": unknown})
+
+            for name, value in fields.items():
+                for data in _DATA_URI_RE.findall(value or ""):
+                    size = len(data) * 3 // 4
+                    if size > max_media_bytes:
+                        problems.append(
+                            {"type": "oversized_media", "field": name, "bytes": size}
+                        )
+
+            cards = []
+            empty = []
+            for template_name, template in model["templates"].items():
+                front = template.get("Front", "")
+                back = template.get("Back", "")
+                if "cloze:" in front:
+                    numbers = sorted(
+                        {
+                            n
+                            for value in fields.values()
+                            for n in _cloze_numbers(value or "")
+                        }
+                    )
+                    variants = [(f"{template_name} c{n}", n) for n in numbers]
+                    if not variants:
+                        empty.append(template_name)
+                else:
+                    variants = [(template_name, None)]
+
+                for card_name, cloze in variants:
+                    question, nonempty = _render_template(front, fields, cloze=cloze)
+                    if not nonempty:
+                        empty.append(card_name)
+                        continue
+                    answer, _ = _render_template(
+                        back, fields, front_side=question, cloze=cloze, question=False
+                    )
+                    card = {"template": card_name}
+                    if include_html:
+                        card["question"] = _DATA_URI_RE.sub("data:...", question)
+                        card["answer"] = _DATA_URI_RE.sub("data:...", answer)
+                    cards.append(card)
+
+            if empty:
+                problems.append({"type": "empty_cards", "templates": empty})
+            if not cards:
+                problems.append({"type": "no_cards"})
+            preview["cards"] = cards
+            preview["ok"] = not any(
+                problem["type"] != "empty_cards" for problem in problems
+            )
+
+        return _dumps(previews)
+
+    def export(
+        self,
+        query: str,
+        output_file: str,
+        file_format: str = "jsonl",
+        kind: str = "notes",
+        fields: list = None,
+        include_tags: bool = True,
+        page_size: int = 500,
+    ) -> str:
+        """
+        Export the notes or cards matching a search query to a JSONL or Parquet file.
+
+        Notes are read and written one page at a time, so memory use stays bounded by
+        page_size regardless of the collection size; only the matching IDs are held in full.
+        Nothing but a short summary is returned to the LLM.
+
+        Each row has the note (noteId, modelName) or card (cardId, note, deckName, modelName,
+        interval, factor, lapses, reps, queue, type) details, the note's tags and a "fields"
+        object mapping field names to values. Card tags are those of the card's note, read
+        with one extra notesInfo request per page. Parquet files store fields as a
+        map<string, string> column.
+
+        Args:
+            query (str): Search query selecting what to export (e.g. "deck:Spanish").
+            output_file (str): Path of the file to write. An existing file is overwritten.
+            file_format (str): "jsonl" or "parquet". Parquet requires pyarrow.
+                Defaults to "jsonl".
+            kind (str): "notes" or "cards". Defaults to "notes".
+            fields (list, optional): Names of the fields to export. Defaults to all fields.
+            include_tags (bool): Include the tags column. Defaults to True.
+            page_size (int): Number of notes or cards read per request. Defaults to 500.
+
+        Returns:
+            str: JSON string with the number of rows written and the output file, or an
+                 error message.
+
+        Example:
+            >>> anki = Anki()
+            >>> result = anki.export("deck:Spanish", "spanish.jsonl", fields=["Front"])
+            >>> result = anki.export("deck:*", "cards.parquet", "parquet", kind="cards")
+        """
+        if file_format not in ("jsonl", "parquet"):
+            return 'Error: file_format must be "jsonl" or "parquet"'
+        if kind not in ("notes", "cards"):
+            return 'Error: kind must be "notes" or "cards"'
+        if file_format == "parquet" and pyarrow is None:
+            return "Error: Parquet export requires pyarrow (pip install pyarrow)"
+
+        if kind == "notes":
+            find_action, info_action, info_param = "findNotes", "notesInfo", "notes"
+            columns = [("noteId", "int64"), ("modelName", "string")]
+        else:
+            find_action, info_action, info_param = "findCards", "cardsInfo", "cards"
+            columns = [
+                ("cardId", "int64"),
+                ("note", "int64"),
+                ("deckName", "string"),
+                ("modelName", "string"),
+                ("interval", "int64"),
+                ("factor", "int64"),
+                ("lapses", "int64"),
+                ("reps", "int64"),
+                ("queue", "int64"),
+                ("type", "int64"),
+            ]
+
+        def to_row(info, tags):
+            row = {name: info.get(name) for name, _ in columns}
+            if include_tags:
+                row["tags"] = tags
+            values = Note.from_info(info).fields
+            if fields is not None:
+                values = {name: values[name] for name in fields if name in values}
+            row["fields"] = values
+            return row
+
+        rows = 0
+        writer = None
+        try:
+            ids = self._invoke(find_action, {"query": query})
+            if file_format == "parquet":
+                schema = pyarrow.schema(
+                    [(name, pyarrow.type_for_alias(type_)) for name, type_ in columns]
+                    + (
+                        [("tags", pyarrow.list_(pyarrow.string()))]
+                        if include_tags
+                        else []
+                    )
+                    + [("fields", pyarrow.map_(pyarrow.string(), pyarrow.string()))]
+                )
+                writer = pyarrow.parquet.ParquetWriter(output_file, schema)
+            else:
+                writer = open(output_file, "w", encoding="utf-8")
+
+            for page in _chunks(ids, page_size):
+                infos = [
+                    info
+                    for info in self._invoke(info_action, {info_param: page})
+                    if info
+                ]
+                if kind == "notes":
+                    tags = {info.get("noteId"): info.get("tags", []) for info in infos}
+                    key = "noteId"
+                else:
+                    # cardsInfo has no tags; read them from the page's notes
+                    tags = {}
+                    if include_tags:
+                        note_ids = list({info.get("note") for info in infos})
+                        for info in self._invoke("notesInfo", {"notes": note_ids}):
+                            if info:
+                                tags[info.get("noteId")] = info.get("tags", [])
+                    key = "note"
+                batch = [to_row(info, tags.get(info.get(key), [])) for info in infos]
+                if file_format == "parquet":
+                    for row in batch:
+                        row["fields"] = list(row["fields"].items())
+                    writer.write_table(
+                        pyarrow.Table.from_pylist(batch, schema=writer.schema)
+                    )
+                else:
+                    writer.writelines(_dumps(row) + "\n" for row in batch)
+                rows += len(batch)
+        except Exception as e:
+            return f"Error: {e}. Rows written before the error: {rows}"
+        finally:
+            if writer is not None:
+                writer.close()
+
+        return json.dumps({"rows": rows, "file": output_file, "format": file_format})
+
+    def changes_since(
+        self,
+        query: str,
+        cursor_file: str,
+        include_reviewed: bool = False,
+        advance_cursor: bool = True,
+    ) -> str:
+        """
+        Report notes added, modified, removed or deleted since the previous call for a query.
+
+        The cursor file stores the time of the previous call and the IDs of the notes that
+        matched then. Added notes and notes that no longer match are found by comparing
+        those IDs with the current matches. Notes that no longer match are read with
+        notesInfo: those gone from the collection are reported as "deleted", those that
+        still exist but left the query (e.g. moved to another deck or untagged) as
+        "removed". Modified notes are found with Anki's "edited:n" search over the
+        days since the previous call plus one (Anki counts days from its daily rollover)
+        and, when AnkiConnect reports note modification times, narrowed to notes changed
+        in or after the second of the previous call. Only the edited notes are read with notesInfo.
+
+        The first call for a cursor file reports every matching note as added.
+
+        Args:
+            query (str): Search query selecting the notes to watch (e.g. "deck:Spanish").
+            cursor_file (str): Path of the JSON file holding the cursor. Created if missing.
+            include_reviewed (bool): Also list notes whose cards were reviewed since the last
+                call (Anki's "rated:n" search, limited by Anki to the last 365 days).
+                Defaults to False.
+            advance_cursor (bool): Save the new cursor. Set to False to peek at the changes
+                without consuming them, e.g. until a downstream job has processed them.
+                Defaults to True.
+
+        Returns:
+            str: JSON string with "added", "modified", "removed" and "deleted" note ID
+                 lists (and "reviewed" if requested) and the "since"/"until" timestamps, or an error
+                 message.
+
+        Example:
+            >>> anki = Anki()
+            >>> result = anki.changes_since("deck:Spanish", "spanish_cursor.json")
+        """
+        cursor = {}
+        if os.path.exists(cursor_file):
+            try:
+                with open(cursor_file, "r", encoding="utf-8") as f:
+                    cursor = json.load(f)
+            except Exception as e:
+                return f"Error reading cursor file: {str(e)}"
+            if cursor.get("query") != query:
+                return (
+                    f"Error: cursor file {cursor_file} was created for the query "
+                    f"{cursor.get('query')!r}, not {query!r}"
+                )
+
+        until = time.time()
+        since = cursor.get("timestamp")
+        known = set(cursor.get("note_ids", []))
+        try:
+            current = self._invoke("findNotes", {"query": query})
+            current_set = set(current)
+            added = [note_id for note_id in current if note_id not in known]
+            deleted = []
+            removed = []
+            gone = sorted(known - current_set)
+            for batch in _chunks(gone, 500):
+                infos = self._invoke("notesInfo", {"notes": batch})
+                for note_id, info in zip(batch, infos):
+                    # notesInfo returns an empty object for deleted notes
+                    (removed if info else deleted).append(note_id)
+            modified = []
+            reviewed = []
+
+            if since is not None:
+                # Anki counts "edited:n" and "rated:n" days from its daily rollover, not
+                # from now, so search one extra day and let the mod check trim it.
+                days = max(1, math.ceil((until - since) / 86400)) + 1
+                edited = [
+                    note_id
+                    for note_id in self._invoke(
+                        "findNotes", {"query": f"({query}) edited:{days}"}
+                    )
+                    if note_id in known
+                ]
+                for batch in _chunks(edited, 500):
+                    for info in self._invoke("notesInfo", {"notes": batch}):
+                        note = Note.from_info(info)
+                        # mod is whole seconds; an edit in the cursor's own second
+                        # is reported again rather than missed
+                        if note.mod is None or note.mod >= int(since):
+                            modified.append(note.note_id)
+                if include_reviewed:
+                    reviewed = self._invoke(
+                        "findNotes", {"query": f"({query}) rated:{min(days, 365)}"}
+                    )
+        except Exception as e:
+            return f"Error: {e}"
+
+        if advance_cursor:
+            try:
+                with open(cursor_file, "w", encoding="utf-8") as f:
+                    json.dump(
+                        {"query": query, "timestamp": until, "note_ids": current}, f
+                    )
+            except Exception as e:
+                return f"Error writing cursor file: {str(e)}"
+
+        changes = {
+            "added": added,
+            "modified": modified,
+            "removed": removed,
+            "deleted": deleted,
+            "since": since,
+            "until": until,
+        }
+        if include_reviewed:
+            changes["reviewed"] = reviewed
+        return _dumps(changes)
+
     def docs(self) -> str:
         """
         Retrieve the AnkiConnect API documentation.
@@ -376,6 +1683,328 @@ class Anki(llm.Toolbox):
         """
         return self._generate_audio_with_gemini(text, language_code)
 
+    def backfill_media(
+        self,
+        query: str,
+        source_field: str,
+        target_field: str,
+        media_type: str = "audio",
+        language_code: str = "en-US",
+        batch_size: int = 50,
+        max_workers: int = 8,
+        checkpoint_file: str = None,
+    ) -> str:
+        """
+        Add audio or images to every matching note that does not have them yet.
+
+        This runs the whole "add audio to all cards in my deck" workflow in one call. Notes
+        matching the query are read in batches; for each note whose target field has no media
+        of the requested type, audio (via Gemini TTS) or an image (via Unsplash) is generated
+        from the source field in parallel, and the updated fields are written back with a
+        single AnkiConnect "multi" request per batch.
+
+        Args:
+            query (str): Search query selecting the notes (e.g. "deck:Spanish").
+            source_field (str): Field whose text is used to generate the media.
+            target_field (str): Field the media is appended to. May be the same as source_field.
+            media_type (str): Either "audio" or "image". Defaults to "audio".
+            language_code (str): Language code used for audio generation. Defaults to "en-US".
+            batch_size (int): Number of notes read and written per batch. Defaults to 50.
+            max_workers (int): Number of media generation requests run concurrently. Defaults to 8.
+            checkpoint_file (str, optional): Path to a JSON file recording finished note IDs.
+                When given, a rerun with the same file skips notes that were already handled,
+                so an interrupted backfill can be resumed.
+
+        Returns:
+            str: JSON string summarising the run (counts of updated and skipped notes, and
+                 any per-note failures, including notes lacking source_field or
+                 target_field), or an error message.
+
+        Example:
+            >>> anki = Anki()
+            >>> result = anki.backfill_media(
+            ...     query="deck:Spanish",
+            ...     source_field="Front",
+            ...     target_field="Back",
+            ...     media_type="audio",
+            ...     language_code="es-ES",
+            ...     checkpoint_file="spanish_audio.json",
+            ... )
+        """
+        if media_type not in ("audio", "image"):
+            return 'Error: media_type must be "audio" or "image"'
+
+        job = {
+            "query": query,
+            "source_field": source_field,
+            "target_field": target_field,
+            "media_type": media_type,
+        }
+        done = set()
+        if checkpoint_file and os.path.exists(checkpoint_file):
+            try:
+                with open(checkpoint_file, "r", encoding="utf-8") as f:
+                    checkpoint = json.load(f)
+            except Exception as e:
+                return f"Error reading checkpoint file: {str(e)}"
+            mismatched = [key for key in job if checkpoint.get(key) != job[key]]
+            if mismatched:
+                return (
+                    f"Error: checkpoint file {checkpoint_file} was created for a "
+                    f"different {', '.join(mismatched)}; use a new checkpoint file"
+                )
+            done = set(checkpoint.get("done", []))
+
+        def generate(text):
+            if media_type == "audio":
+                return self._audio_html(self._synthesize_speech(text, language_code))
+            url = self.get_image_url(text)
+            if url.startswith("https://source.unsplash.com/"):
+                raise RuntimeError(
+                    "No Unsplash image found (is UNSPLASH_ACCESS_KEY set?)"
+                )
+            return f'<img src="{html.escape(url)}">'
+
+        summary = {"matched": 0, "updated": 0, "skipped": 0, "failed": []}
+        try:
+            note_ids = self._invoke("findNotes", {"query": query})
+            summary["matched"] = len(note_ids)
+            pending = [note_id for note_id in note_ids if note_id not in done]
+            summary["skipped"] = len(note_ids) - len(pending)
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for batch in _chunks(pending, batch_size):
+                    notes = self._invoke("notesInfo", {"notes": batch})
+                    candidates = []
+                    failed_ids = set()
+                    for note in map(Note.from_info, notes):
+                        # A misspelled field must not mark the note as done
+                        missing = [
+                            name
+                            for name in (source_field, target_field)
+                            if name not in note.fields
+                        ]
+                        if missing:
+                            summary["failed"].append(
+                                {
+                                    "noteId": note.note_id,
+                                    "error": f"Note has no field {missing[0]!r}",
+                                }
+                            )
+                            failed_ids.add(note.note_id)
+                            continue
+                        # Only the plain text is spoken or used as the image search
+                        source = note.fields[source_field] or ""
+                        source = _strip_html(
+                            _SOUND_TAG_RE.sub(" ", _MEDIA_TAG_RE.sub(" ", source))
+                        )
+                        target = note.fields[target_field] or ""
+                        if not source:
+                            summary["skipped"] += 1
+                            continue
+                        if _has_media(target, media_type):
+                            summary["skipped"] += 1
+                            continue
+                        candidates.append((note.note_id, source, target))
+
+                    futures = [
+                        (note_id, target, executor.submit(generate, source))
+                        for note_id, source, target in candidates
+                    ]
+                    actions = []
+                    action_ids = []
+                    for note_id, target, future in futures:
+                        try:
+                            media_html = future.result()
+                        except Exception as e:
+                            summary["failed"].append(
+                                {"noteId": note_id, "error": str(e)}
+                            )
+                            failed_ids.add(note_id)
+                            continue
+                        actions.append(
+                            {
+                                "action": "updateNoteFields",
+                                # Version 6 reports each action's error separately
+                                # instead of aborting the whole multi request
+                                "version": 6,
+                                "params": {
+                                    "note": {
+                                        "id": note_id,
+                                        "fields": {target_field: target + media_html},
+                                    }
+                                },
+                            }
+                        )
+                        action_ids.append(note_id)
+
+                    if actions:
+                        results = self._invoke("multi", {"actions": actions})
+                        for note_id, result in zip(action_ids, results):
+                            error = (
+                                result.get("error")
+                                if isinstance(result, dict)
+                                else "unexpected multi result"
+                            )
+                            if error:
+                                summary["failed"].append(
+                                    {"noteId": note_id, "error": error}
+                                )
+                                failed_ids.add(note_id)
+                            else:
+                                summary["updated"] += 1
+
+                    done.update(
+                        note_id for note_id in batch if note_id not in failed_ids
+                    )
+                    if checkpoint_file:
+                        with open(checkpoint_file, "w", encoding="utf-8") as f:
+                            json.dump({**job, "done": sorted(done)}, f)
+        except Exception as e:
+            summary["error"] = str(e)
+            return f"Error: {e}. Progress so far: {json.dumps(summary)}"
+
+        return json.dumps(summary)
+
+    def sync_media(
+        self,
+        directory: str,
+        pattern: str = "*",
+        max_workers: int = 4,
+        manifest_file: str = None,
+    ) -> str:
+        """
+        Upload the media files in a local directory to Anki's media folder.
+
+        Only new or changed files are uploaded. A manifest recording the size, modification
+        time and SHA-1 hash of every synced file is kept in the directory, so re-syncing an
+        unchanged directory only needs to stat the files. New or modified files are hashed,
+        in a process pool when there are many of them, and files not yet in the manifest are
+        compared with the copy already in Anki (via retrieveMediaFile) before uploading.
+        Files that cannot be read are reported as failures without stopping the sync.
+
+        Files are stored with their base name, since Anki's media folder is flat. Uploads pass
+        the local path to storeMediaFile, falling back to base64 data for AnkiConnect
+        versions that do not support paths.
+
+        Args:
+            directory (str): Directory to sync. Subdirectories are included.
+            pattern (str): Glob pattern selecting file names (e.g. "*.mp3"). Defaults to "*".
+            max_workers (int): Number of concurrent hashing processes and uploads. Defaults to 4.
+            manifest_file (str, optional): Path of the manifest file. Defaults to
+                ".anki_media_manifest.json" inside the directory.
+
+        Returns:
+            str: JSON string with the number of files found, uploaded and unchanged, and any
+                 per-file failures, or an error message.
+
+        Example:
+            >>> anki = Anki()
+            >>> result = anki.sync_media("/home/me/spanish/audio", pattern="*.mp3")
+        """
+        if not os.path.isdir(directory):
+            return f"Error: {directory} is not a directory"
+        manifest_file = manifest_file or os.path.join(directory, _MEDIA_MANIFEST_NAME)
+
+        manifest = {}
+        if os.path.exists(manifest_file):
+            try:
+                with open(manifest_file, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+            except Exception as e:
+                return f"Error reading manifest file: {str(e)}"
+
+        summary = {"files": 0, "uploaded": 0, "unchanged": 0, "failed": []}
+        files = {}
+        for root, _, names in os.walk(directory):
+            for name in fnmatch.filter(names, pattern):
+                path = os.path.abspath(os.path.join(root, name))
+                if path == os.path.abspath(manifest_file):
+                    continue
+                if name in files:
+                    summary["failed"].append(
+                        {"file": path, "error": f"duplicate media name {name}"}
+                    )
+                    continue
+                files[name] = path
+        summary["files"] = len(files)
+
+        stats = {}
+        for name, path in files.items():
+            try:
+                stats[name] = os.stat(path)
+            except OSError as e:
+                summary["failed"].append({"file": path, "error": str(e)})
+        changed = [
+            name
+            for name in stats
+            if manifest.get(name, {}).get("size") != stats[name].st_size
+            or manifest.get(name, {}).get("mtime") != stats[name].st_mtime
+        ]
+        summary["unchanged"] = len(stats) - len(changed)
+
+        paths = [files[name] for name in changed]
+        hashes = None
+        if len(paths) >= _PROCESS_HASH_MIN_FILES:
+            # Spawn rather than fork: the toolbox runs inside a multi-threaded process
+            context = multiprocessing.get_context("spawn")
+            try:
+                with ProcessPoolExecutor(max_workers, mp_context=context) as executor:
+                    hashes = list(executor.map(_try_hash_file, paths, chunksize=16))
+            except (BrokenProcessPool, OSError, RuntimeError):
+                # e.g. a host program without a __main__ guard; hash in-process instead
+                hashes = None
+        if hashes is None:
+            hashes = [_try_hash_file(path) for path in paths]
+
+        digests = {}
+        for name, (digest, error) in zip(changed, hashes):
+            if error is not None:
+                summary["failed"].append({"file": files[name], "error": error})
+            else:
+                digests[name] = digest
+        changed = [name for name in changed if name in digests]
+
+        def sync(name):
+            digest = digests[name]
+            known = manifest.get(name, {}).get("sha1")
+            if known is None:
+                existing = self._invoke("retrieveMediaFile", {"filename": name})
+                if existing:
+                    known = hashlib.sha1(base64.b64decode(existing)).hexdigest()
+            if known == digest:
+                return False
+            try:
+                self._invoke("storeMediaFile", {"filename": name, "path": files[name]})
+            except RuntimeError:
+                with open(files[name], "rb") as f:
+                    data = base64.b64encode(f.read()).decode("ascii")
+                self._invoke("storeMediaFile", {"filename": name, "data": data})
+            return True
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = [(name, executor.submit(sync, name)) for name in changed]
+            for name, future in results:
+                try:
+                    uploaded = future.result()
+                except Exception as e:
+                    summary["failed"].append({"file": files[name], "error": str(e)})
+                    continue
+                summary["uploaded" if uploaded else "unchanged"] += 1
+                manifest[name] = {
+                    "size": stats[name].st_size,
+                    "mtime": stats[name].st_mtime,
+                    "sha1": digests[name],
+                }
+
+        try:
+            with open(manifest_file, "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+        except Exception as e:
+            return f"Error writing manifest file: {str(e)}"
+
+        return json.dumps(summary)
+
     def _generate_audio_with_gemini(
         self,
         text: str,
@@ -418,56 +2047,10 @@ class Anki(llm.Toolbox):
 
         """
         try:
-            # Get Gemini API key from environment
-            if not self.gemini_api_key:
-                return "Error: GEMINI_API_KEY environment variable not set"
-
-            headers = {
-                "Content-Type": "application/json",
-                "x-goog-api-key": self.gemini_api_key,
-            }
-
-            # Set default voice
-            voice_name = "en-US-Neural2-F"
-            if language_code == "en-US":
-                voice_name = "en-US-Neural2-F"
-            elif language_code == "es-ES":
-                voice_name = "es-ES-Neural2-A"
-            elif language_code == "fr-FR":
-                voice_name = "fr-FR-Neural2-A"
-            else:
-                voice_name = f"{language_code}-Neural2-A"
-
-            # Build voice configuration
-            voice_config = {
-                "languageCode": language_code,
-                "name": voice_name,
-            }
-
-            payload = {
-                "input": {"text": text},
-                "voice": voice_config,
-                "audioConfig": {"audioEncoding": "LINEAR16", "speakingRate": 0.85},
-            }
-
-            response = httpx.post(
-                "https://texttospeech.googleapis.com/v1/text:synthesize",
-                headers=headers,
-                json=payload,
-                timeout=30.0,
-            )
-            response.raise_for_status()
-
-            # Get the response data
-            result = response.json()
-
-            # Extract the base64 audio content
-            audio_content = result.get("audioContent")
-            if not audio_content:
-                return "Error: No audio content in response"
+            audio_content = self._synthesize_speech(text, language_code)
 
             # Create HTML audio element with base64 encoded audio
-            audio_html = f'<audio controls><source src="data:audio/wav;base64,{audio_content}" type="audio/wav">Your browser does not support the audio element.</audio>'
+            audio_html = self._audio_html(audio_content)
 
             # Write HTML to temporary file
             with tempfile.NamedTemporaryFile(
@@ -483,6 +2066,154 @@ class Anki(llm.Toolbox):
         except Exception as e:
             return f"Error: {str(e)}"
 
+    def _synthesize_speech(self, text: str, language_code: str = "en-US") -> str:
+        """
+        Synthesize speech for text with Gemini's TTS API.
+
+        Texts longer than _TTS_CHUNK_CHARS are split into one chunk per sentence, the
+        chunks are synthesized concurrently and the resulting WAV segments are joined
+        locally. Each chunk is cached on disk, so re-synthesizing an edited passage, even
+        in a later session, only requests the chunks that changed.
+
+        Returns:
+            str: The base64-encoded LINEAR16 audio content.
+
+        Raises:
+            RuntimeError: If the API key is missing or the response has no audio.
+            httpx.HTTPStatusError: If the API returns an error status.
+        """
+        chunks = [text] if len(text) <= _TTS_CHUNK_CHARS else _split_sentences(text)
+        if len(chunks) == 1:
+            audio = self._synthesize_chunk(chunks[0], language_code)
+        else:
+            workers = min(len(chunks), _TTS_MAX_CONCURRENCY)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                segments = list(
+                    executor.map(
+                        lambda chunk: self._synthesize_chunk(chunk, language_code),
+                        chunks,
+                    )
+                )
+            audio = _concat_audio(segments)
+        return base64.b64encode(audio).decode("ascii")
+
+    def _synthesize_chunk(self, text: str, language_code: str = "en-US") -> bytes:
+        """
+        Synthesize a single TTS request, returning the decoded audio bytes.
+
+        Results are cached in the llm user directory, keyed by a hash of the language
+        code and text, see _store_tts_cache. At most _TTS_MAX_CONCURRENCY requests run at once, also when
+        called from backfill_media's worker threads.
+        """
+        key = hashlib.sha256(f"{language_code}\n{text}".encode("utf-8")).hexdigest()
+        cache_path = self._tts_cache_dir / f"{key}.audio"
+        if self._tts_cache_max_bytes > 0:
+            try:
+                audio = cache_path.read_bytes()
+                # Mark the entry as recently used for eviction
+                os.utime(cache_path)
+                return audio
+            except OSError:
+                pass
+
+        # Get Gemini API key from environment
+        if not self.gemini_api_key:
+            raise RuntimeError("GEMINI_API_KEY environment variable not set")
+
+        headers = {
+            "Content-Type": "application/json",
+            "x-goog-api-key": self.gemini_api_key,
+        }
+
+        # Set default voice
+        voice_name = "en-US-Neural2-F"
+        if language_code == "en-US":
+            voice_name = "en-US-Neural2-F"
+        elif language_code == "es-ES":
+            voice_name = "es-ES-Neural2-A"
+        elif language_code == "fr-FR":
+            voice_name = "fr-FR-Neural2-A"
+        else:
+            voice_name = f"{language_code}-Neural2-A"
+
+        # Build voice configuration
+        voice_config = {
+            "languageCode": language_code,
+            "name": voice_name,
+        }
+
+        payload = {
+            "input": {"text": text},
+            "voice": voice_config,
+            "audioConfig": {"audioEncoding": "LINEAR16", "speakingRate": 0.85},
+        }
+
+        with self._tts_slots:
+            response = self._send(
+                "POST",
+                "https://texttospeech.googleapis.com/v1/text:synthesize",
+                headers=headers,
+                json=payload,
+                timeout=30.0,
+            )
+        response.raise_for_status()
+
+        # Extract the base64 audio content
+        audio_content = _loads(response).get("audioContent")
+        if not audio_content:
+            raise RuntimeError("No audio content in response")
+        audio = base64.b64decode(audio_content)
+        if self._tts_cache_max_bytes > 0:
+            self._store_tts_cache(cache_path, audio)
+        return audio
+
+    def _store_tts_cache(self, cache_path: pathlib.Path, audio: bytes) -> None:
+        """
+        Write synthesized audio to the TTS cache, evicting old entries when it is full.
+
+        When the cache grows past its size bound, the least recently used entries are
+        removed until it is back under 90% of the bound, so eviction does not run on
+        every write. Cache errors are ignored; the audio is simply synthesized again.
+        """
+        with self._tts_cache_lock:
+            try:
+                self._tts_cache_dir.mkdir(parents=True, exist_ok=True)
+                # Write then rename, so concurrent readers never see a partial file
+                temp_path = cache_path.with_suffix(f".{threading.get_ident()}.tmp")
+                temp_path.write_bytes(audio)
+                os.replace(temp_path, cache_path)
+
+                if self._tts_cache_bytes is None:
+                    self._tts_cache_bytes = sum(
+                        path.stat().st_size
+                        for path in self._tts_cache_dir.glob("*.audio")
+                    )
+                else:
+                    self._tts_cache_bytes += len(audio)
+                if self._tts_cache_bytes <= self._tts_cache_max_bytes:
+                    return
+
+                entries = []
+                for path in self._tts_cache_dir.glob("*.audio"):
+                    stat = path.stat()
+                    entries.append((stat.st_mtime, path, stat.st_size))
+                entries.sort(key=lambda entry: entry[0])
+                total = sum(size for _, _, size in entries)
+                for _, path, size in entries:
+                    if total <= self._tts_cache_max_bytes * 0.9:
+                        break
+                    path.unlink(missing_ok=True)
+                    total -= size
+                self._tts_cache_bytes = total
+            except OSError:
+                # Rescan on the next write
+                self._tts_cache_bytes = None
+
+    @staticmethod
+    def _audio_html(audio_content: str) -> str:
+        """Wrap base64-encoded WAV audio in an HTML audio element."""
+        return f'<audio controls><source src="data:audio/wav;base64,{audio_content}" type="audio/wav">Your browser does not support the audio element.</audio>'
+
 
 # def schema(self) -> str:
 #     """
@@ -1,7 +1,38 @@
+import base64
+import io
 import json
+import os
+import pathlib
+import tempfile
+import time
+import wave
 import httpx
+import pytest
 from unittest.mock import patch, Mock
-from llm_tools_anki import Anki
+import llm_tools_anki
+from llm_tools_anki import Anki, Card, Note
+
+
+def json_response(payload, url="http://localhost:8765/"):
+    """Build a real httpx response with a JSON body, as the services return."""
+    return httpx.Response(200, json=payload, request=httpx.Request("POST", url))
+
+
+def fake_server(handler):
+    """
+    Build an httpx.post side effect that answers every request with handler(url, body).
+
+    For AnkiConnect requests the handler returns the action's result, which is wrapped
+    in {"result": ..., "error": null}; for other services it returns the whole body.
+    """
+
+    def respond(url, json=None, **kwargs):
+        payload = handler(url, json)
+        if url.startswith("http://localhost:8765"):
+            payload = {"result": payload, "error": None}
+        return json_response(payload, url)
+
+    return respond
 
 
 class TestAnki:
@@ -10,16 +41,16 @@ class TestAnki:
     def setup_method(self):
         """Set up test fixtures."""
         self.anki = Anki()
+        self.anki._tts_cache_dir = pathlib.Path(tempfile.mkdtemp())
         self.base_url = "http://localhost:8765"
 
     @patch("httpx.post")
     def test_query_success(self, mock_post):
         """Test successful query to AnkiConnect."""
         # Mock successful response
-        mock_response = Mock()
-        mock_response.json.return_value = {"result": {"note_id": 12345}, "error": None}
-        mock_response.raise_for_status.return_value = None
-        mock_post.return_value = mock_response
+        mock_post.return_value = json_response(
+            {"result": {"note_id": 12345}, "error": None}
+        )
 
         request = json.dumps(
             {
@@ -47,13 +78,12 @@ class TestAnki:
     def test_query_with_error(self, mock_post):
         """Test query that returns an error from AnkiConnect."""
         # Mock error response
-        mock_response = Mock()
-        mock_response.json.return_value = {
-            "result": None,
-            "error": "Deck 'NonExistent' does not exist",
-        }
-        mock_response.raise_for_status.return_value = None
-        mock_post.return_value = mock_response
+        mock_post.return_value = json_response(
+            {
+                "result": None,
+                "error": "Deck 'NonExistent' does not exist",
+            }
+        )
 
         request = json.dumps(
             {
@@ -87,10 +117,7 @@ class TestAnki:
     @patch("httpx.post")
     def test_add_note_success(self, mock_post):
         """Test successful note addition."""
-        mock_response = Mock()
-        mock_response.json.return_value = {"result": 12345, "error": None}
-        mock_response.raise_for_status.return_value = None
-        mock_post.return_value = mock_response
+        mock_post.return_value = json_response({"result": 12345, "error": None})
 
         result = self.anki.add_note(
             deck_name="Default",
@@ -118,10 +145,9 @@ class TestAnki:
     @patch("httpx.post")
     def test_add_notes_batch(self, mock_post):
         """Test adding multiple notes in batch."""
-        mock_response = Mock()
-        mock_response.json.return_value = {"result": [12345, 12346], "error": None}
-        mock_response.raise_for_status.return_value = None
-        mock_post.return_value = mock_response
+        mock_post.return_value = json_response(
+            {"result": [12345, 12346], "error": None}
+        )
 
         notes = [
             {
@@ -153,10 +179,7 @@ class TestAnki:
     @patch("httpx.post")
     def test_update_note_fields(self, mock_post):
         """Test updating note fields."""
-        mock_response = Mock()
-        mock_response.json.return_value = {"result": None, "error": None}
-        mock_response.raise_for_status.return_value = None
-        mock_post.return_value = mock_response
+        mock_post.return_value = json_response({"result": None, "error": None})
 
         result = self.anki.update_note_fields(
             note_id=1514547547030,
@@ -180,10 +203,9 @@ class TestAnki:
     @patch("httpx.post")
     def test_find_notes(self, mock_post):
         """Test finding notes with search query."""
-        mock_response = Mock()
-        mock_response.json.return_value = {"result": [12345, 12346], "error": None}
-        mock_response.raise_for_status.return_value = None
-        mock_post.return_value = mock_response
+        mock_post.return_value = json_response(
+            {"result": [12345, 12346], "error": None}
+        )
 
         result = self.anki.find_notes("deck:current")
 
@@ -200,23 +222,22 @@ class TestAnki:
     @patch("httpx.post")
     def test_get_notes_info(self, mock_post):
         """Test getting detailed note information."""
-        mock_response = Mock()
-        mock_response.json.return_value = {
-            "result": [
-                {
-                    "noteId": 12345,
-                    "modelName": "Basic",
-                    "tags": ["test"],
-                    "fields": {
-                        "Front": {"value": "Question"},
-                        "Back": {"value": "Answer"},
-                    },
-                }
-            ],
-            "error": None,
-        }
-        mock_response.raise_for_status.return_value = None
-        mock_post.return_value = mock_response
+        mock_post.return_value = json_response(
+            {
+                "result": [
+                    {
+                        "noteId": 12345,
+                        "modelName": "Basic",
+                        "tags": ["test"],
+                        "fields": {
+                            "Front": {"value": "Question"},
+                            "Back": {"value": "Answer"},
+                        },
+                    }
+                ],
+                "error": None,
+            }
+        )
 
         result = self.anki.get_notes_info([12345])
 
@@ -236,13 +257,12 @@ class TestAnki:
     @patch("httpx.post")
     def test_get_deck_names(self, mock_post):
         """Test getting all deck names."""
-        mock_response = Mock()
-        mock_response.json.return_value = {
-            "result": ["Default", "Math", "Science"],
-            "error": None,
-        }
-        mock_response.raise_for_status.return_value = None
-        mock_post.return_value = mock_response
+        mock_post.return_value = json_response(
+            {
+                "result": ["Default", "Math", "Science"],
+                "error": None,
+            }
+        )
 
         result = self.anki.get_deck_names()
 
@@ -258,13 +278,12 @@ class TestAnki:
     @patch("httpx.post")
     def test_get_deck_names_and_ids(self, mock_post):
         """Test getting deck names and their IDs."""
-        mock_response = Mock()
-        mock_response.json.return_value = {
-            "result": {"Default": 1, "Math": 2, "Science": 3},
-            "error": None,
-        }
-        mock_response.raise_for_status.return_value = None
-        mock_post.return_value = mock_response
+        mock_post.return_value = json_response(
+            {
+                "result": {"Default": 1, "Math": 2, "Science": 3},
+                "error": None,
+            }
+        )
 
         result = self.anki.get_deck_names_and_ids()
 
@@ -280,17 +299,16 @@ class TestAnki:
     @patch("httpx.post")
     def test_get_deck_config(self, mock_post):
         """Test getting deck configuration."""
-        mock_response = Mock()
-        mock_response.json.return_value = {
-            "result": {
-                "name": "Default",
-                "new": {"perDay": 20},
-                "review": {"perDay": 100},
-            },
-            "error": None,
-        }
-        mock_response.raise_for_status.return_value = None
-        mock_post.return_value = mock_response
+        mock_post.return_value = json_response(
+            {
+                "result": {
+                    "name": "Default",
+                    "new": {"perDay": 20},
+                    "review": {"perDay": 100},
+                },
+                "error": None,
+            }
+        )
 
         result = self.anki.get_deck_config("Default")
 
@@ -326,10 +344,7 @@ class TestAnki:
     @patch("httpx.post")
     def test_query_with_empty_result(self, mock_post):
         """Test query that returns empty result."""
-        mock_response = Mock()
-        mock_response.json.return_value = {"result": None, "error": None}
-        mock_response.raise_for_status.return_value = None
-        mock_post.return_value = mock_response
+        mock_post.return_value = json_response({"result": None, "error": None})
 
         request = json.dumps({"action": "test", "version": 5})
         result = self.anki.query(request)
@@ -339,16 +354,829 @@ class TestAnki:
     @patch("httpx.post")
     def test_query_with_missing_result(self, mock_post):
         """Test query that doesn't include result in response."""
-        mock_response = Mock()
-        mock_response.json.return_value = {"error": None}
-        mock_response.raise_for_status.return_value = None
-        mock_post.return_value = mock_response
+        mock_post.return_value = json_response({"error": None})
 
         request = json.dumps({"action": "test", "version": 5})
         result = self.anki.query(request)
 
         assert result == "{}"
 
+    @patch("httpx.post")
+    def test_backfill_media_audio(self, mock_post):
+        """Test backfilling audio only for notes that lack it."""
+        notes = [
+            {
+                "noteId": 1,
+                "fields": {"Front": {"value": "hola"}, "Back": {"value": "hello"}},
+            },
+            {
+                "noteId": 2,
+                "fields": {
+                    "Front": {"value": "adios"},
+                    "Back": {"value": "bye<audio controls></audio>"},
+                },
+            },
+        ]
+        calls = []
+
+        def handler(url, body):
+            calls.append((url, body))
+            if "texttospeech" in url:
+                return {"audioContent": "QUJD"}
+            if body["action"] == "findNotes":
+                return [1, 2]
+            if body["action"] == "notesInfo":
+                return notes
+            return [{"result": None, "error": None}]
+
+        mock_post.side_effect = fake_server(handler)
+        self.anki.gemini_api_key = "test-key"
+
+        result = json.loads(
+            self.anki.backfill_media("deck:Spanish", "Front", "Back", "audio")
+        )
+
+        assert result == {"matched": 2, "updated": 1, "skipped": 1, "failed": []}
+        multi = [body for url, body in calls if body.get("action") == "multi"]
+        assert len(multi) == 1
+        actions = multi[0]["params"]["actions"]
+        assert actions[0]["version"] == 6
+        assert actions[0]["params"]["note"]["id"] == 1
+        updated = actions[0]["params"]["note"]["fields"]["Back"]
+        assert updated.startswith("hello<audio")
+        assert "base64,QUJD" in updated
+
+    @patch("httpx.post")
+    def test_backfill_media_resumes_from_checkpoint(self, mock_post, tmp_path):
+        """Test that notes recorded in the checkpoint file are not fetched again."""
+        checkpoint = tmp_path / "checkpoint.json"
+        job = {
+            "query": "deck:Spanish",
+            "source_field": "Front",
+            "target_field": "Back",
+            "media_type": "audio",
+        }
+        checkpoint.write_text(json.dumps({**job, "done": [1, 2]}))
+        mock_post.return_value = json_response({"result": [1, 2], "error": None})
+
+        result = json.loads(
+            self.anki.backfill_media(
+                "deck:Spanish", "Front", "Back", checkpoint_file=str(checkpoint)
+            )
+        )
+
+        assert mock_post.call_count == 1
+        assert result["skipped"] == 2
+        assert result["updated"] == 0
+
+        result = self.anki.backfill_media(
+            "deck:Spanish", "Front", "Extra", checkpoint_file=str(checkpoint)
+        )
+        assert result.startswith("Error: checkpoint file")
+        assert "target_field" in result
+
+    @patch("httpx.post")
+    def test_backfill_media_strips_html_and_reports_failures(self, mock_post):
+        """Test source HTML is stripped and image fallbacks and write errors fail."""
+        notes = [
+            {
+                "noteId": i,
+                "fields": {
+                    "Front": {"value": "<b>gato</b>&nbsp;"},
+                    "Back": {"value": ""},
+                },
+            }
+            for i in (1, 2, 3)
+        ]
+        image_queries = []
+
+        def get_image_url(query):
+            image_queries.append(query)
+            if len(image_queries) == 1:
+                return f"https://source.unsplash.com/random/400x300/?{query}"
+            return "https://images.example/cat.jpg?w=400&h=300"
+
+        def handler(url, body):
+            if body["action"] == "findNotes":
+                return [1, 2, 3]
+            if body["action"] == "notesInfo":
+                return notes
+            return [
+                {"result": None, "error": None},
+                {"result": None, "error": "note was deleted"},
+            ]
+
+        mock_post.side_effect = fake_server(handler)
+
+        with patch.object(self.anki, "get_image_url", side_effect=get_image_url):
+            result = json.loads(
+                self.anki.backfill_media(
+                    "deck:Spanish", "Front", "Back", "image", max_workers=1
+                )
+            )
+
+        assert image_queries == ["gato"] * 3
+        assert result["updated"] == 1
+        assert [failure["noteId"] for failure in result["failed"]] == [1, 3]
+        assert "UNSPLASH_ACCESS_KEY" in result["failed"][0]["error"]
+        actions = mock_post.call_args[1]["json"]["params"]["actions"]
+        assert actions[0]["params"]["note"]["fields"]["Back"] == (
+            '<img src="https://images.example/cat.jpg?w=400&amp;h=300">'
+        )
+
+    @patch("httpx.post")
+    def test_backfill_media_missing_field_fails(self, mock_post, tmp_path):
+        """Test notes without the source or target field fail and stay unfinished."""
+        checkpoint = tmp_path / "checkpoint.json"
+        notes = [
+            {"noteId": 1, "fields": {"Front": {"value": "hola"}}},
+            {"noteId": 2, "fields": {"Back": {"value": "bye"}}},
+            {"noteId": 3, "fields": {"Front": {"value": ""}, "Back": {"value": ""}}},
+        ]
+
+        def handler(url, body):
+            if body["action"] == "findNotes":
+                return [1, 2, 3]
+            return notes
+
+        mock_post.side_effect = fake_server(handler)
+
+        result = json.loads(
+            self.anki.backfill_media(
+                "deck:Spanish", "Front", "Back", checkpoint_file=str(checkpoint)
+            )
+        )
+
+        assert result["updated"] == 0
+        assert result["skipped"] == 1
+        assert result["failed"] == [
+            {"noteId": 1, "error": "Note has no field 'Back'"},
+            {"noteId": 2, "error": "Note has no field 'Front'"},
+        ]
+        assert json.loads(checkpoint.read_text())["done"] == [3]
+
+    @patch("httpx.post")
+    def test_get_notes_info_compact(self, mock_post):
+        """Test compact output flattens fields and strips HTML."""
+        mock_post.return_value = json_response(
+            {
+                "result": [
+                    {
+                        "noteId": 12345,
+                        "tags": ["test"],
+                        "fields": {
+                            "Back": {"value": "<i>Answer</i>", "order": 1},
+                            "Front": {
+                                "value": "<b>Question</b><audio controls></audio>",
+                                "order": 0,
+                            },
+                        },
+                    }
+                ],
+                "error": None,
+            }
+        )
+
+        result = self.anki.get_notes_info(
+            [12345], output_format="compact", strip_html=True
+        )
+
+        assert result == (
+            '[{"noteId":12345,"tags":["test"],'
+            '"fields":{"Front":"Question [audio]","Back":"Answer"}}]'
+        )
+
+    @patch("httpx.post")
+    def test_find_notes_table_with_continuation(self, mock_post):
+        """Test table output with truncation returns a continuation handle."""
+        mock_post.return_value = json_response(
+            {"result": [1, 2, 3, 4, 5], "error": None}
+        )
+
+        result = self.anki.find_notes("deck:current", output_format="table", limit=2)
+        assert result == "value\n1\n2\n# more: next_offset=2 total=5\n"
+
+        result = self.anki.find_notes("deck:current", limit=2, offset=4)
+        assert json.loads(result) == [5]
+
+        result = self.anki.find_notes("deck:current", output_format="compact", limit=2)
+        assert json.loads(result) == {"items": [1, 2], "next_offset": 2, "total": 5}
+
+    @patch("httpx.post")
+    def test_strip_html_only_touches_field_values(self, mock_post):
+        """Test strip_html keeps the json shape and leaves tags and deck names alone."""
+        mock_post.return_value = json_response(
+            {
+                "result": [
+                    {
+                        "noteId": 1,
+                        "tags": ["<b>raw</b>"],
+                        "fields": {"Front": {"value": "<b>Q</b>", "order": 0}},
+                    }
+                ],
+                "error": None,
+            }
+        )
+
+        result = json.loads(self.anki.get_notes_info([1], strip_html=True))
+
+        assert result == [
+            {
+                "noteId": 1,
+                "tags": ["<b>raw</b>"],
+                "fields": {"Front": {"value": "Q", "order": 0}},
+            }
+        ]
+
+    @patch("httpx.post")
+    def test_find_notes_rejects_invalid_pagination(self, mock_post):
+        """Test limit below 1 and negative offsets are rejected."""
+        mock_post.return_value = json_response({"result": [1, 2], "error": None})
+
+        assert self.anki.find_notes("deck:current", limit=0) == (
+            "Error: limit must be at least 1"
+        )
+        assert self.anki.find_notes("deck:current", limit=-1).startswith("Error:")
+        assert self.anki.find_notes("deck:current", offset=-1) == (
+            "Error: offset must not be negative"
+        )
+        mock_post.assert_not_called()
+
+    def test_query_invalid_output_format(self):
+        """Test query rejects unknown output formats."""
+        with patch("httpx.post") as mock_post:
+            mock_post.return_value = json_response({"result": [], "error": None})
+            result = self.anki.query(
+                '{"action": "addNote", "params": {}}', output_format="xml"
+            )
+        assert result.startswith("Error: output_format must be one of")
+        mock_post.assert_not_called()
+
+    def _cards_backend(self, cards, mod_times, calls):
+        """Build an httpx.post side effect serving a small card collection."""
+
+        def handler(url, body):
+            calls.append(body["action"])
+            requested = body.get("params", {}).get("cards", [])
+            results = {
+                "findCards": [card["cardId"] for card in cards],
+                "cardsModTime": [
+                    {"cardId": card_id, "mod": mod_times[card_id]}
+                    for card_id in requested
+                ],
+                "cardsInfo": [c for c in cards if c["cardId"] in requested],
+                "areDue": [card_id == 1 for card_id in requested],
+            }
+            return results[body["action"]]
+
+        return fake_server(handler)
+
+    @patch("httpx.post")
+    def test_card_stats(self, mock_post):
+        """Test review statistics are aggregated locally and card info is cached."""
+        cards = [
+            {
+                "cardId": 1,
+                "note": 10,
+                "deckName": "Spanish",
+                "interval": 0,
+                "factor": 2500,
+                "lapses": 0,
+                "reps": 2,
+                "queue": 1,
+            },
+            {
+                "cardId": 2,
+                "note": 11,
+                "deckName": "Spanish",
+                "interval": 30,
+                "factor": 1300,
+                "lapses": 9,
+                "reps": 20,
+                "queue": 2,
+            },
+            {
+                "cardId": 3,
+                "note": 12,
+                "deckName": "French",
+                "interval": 5,
+                "factor": 2300,
+                "lapses": 1,
+                "reps": 4,
+                "queue": -1,
+            },
+        ]
+        mod_times = {1: 100, 2: 100, 3: 100}
+        calls = []
+        mock_post.side_effect = self._cards_backend(cards, mod_times, calls)
+
+        result = json.loads(self.anki.card_stats("deck:*"))
+
+        assert result["cards"] == 3
+        assert result["due"] == 1
+        assert result["suspended"] == 1
+        assert result["leeches"] == 1
+        assert result["interval_distribution"]["new/learning"] == 1
+        assert result["interval_distribution"]["2-7d"] == 1
+        assert result["interval_distribution"]["22-90d"] == 1
+        assert result["most_lapses"][0]["cardId"] == 2
+        assert result["lowest_ease"][0]["ease"] == 1.3
+        assert result["decks"]["Spanish"]["mature"] == 1
+        assert result["decks"]["Spanish"]["retention_estimate"] == round(1 - 9 / 22, 3)
+
+        calls.clear()
+        mod_times[3] = 200
+        leeches = json.loads(self.anki.find_leeches("deck:*"))
+
+        assert [card["cardId"] for card in leeches] == [2]
+        assert calls == ["findCards", "cardsModTime", "cardsInfo"]
+        assert mock_post.call_args[1]["json"]["params"]["cards"] == [3]
+
+    @patch("httpx.post")
+    def test_query_uses_fast_json_backend(self, mock_post):
+        """Test responses are decoded with the optional fast JSON backend."""
+        mock_post.return_value = json_response({"result": [1, 2], "error": None})
+        fast_loads = Mock(side_effect=json.loads)
+
+        with patch.object(llm_tools_anki, "_fast_loads", fast_loads):
+            result = self.anki.find_notes("deck:current", output_format="compact")
+
+        fast_loads.assert_called_once_with(mock_post.return_value.content)
+        assert result == "[1,2]"
+
+    def test_note_and_card_from_info(self):
+        """Test decoding notesInfo and cardsInfo entries into slotted objects."""
+        note = Note.from_info(
+            {
+                "noteId": 1,
+                "modelName": "Basic",
+                "tags": ["a"],
+                "fields": {
+                    "Back": {"value": "b", "order": 1},
+                    "Front": {"value": "f", "order": 0},
+                },
+            }
+        )
+        assert list(note.fields.items()) == [("Front", "f"), ("Back", "b")]
+        assert not hasattr(note, "__dict__")
+
+        card = Card.from_info(
+            {"cardId": 2, "note": 1, "deckName": "Default", "factor": 2500}
+        )
+        assert card.ease == 2.5
+        assert card.summary() == {
+            "cardId": 2,
+            "note": 1,
+            "deckName": "Default",
+            "lapses": 0,
+            "ease": 2.5,
+            "interval": 0,
+        }
+
+    @patch("httpx.post")
+    def test_sync_media_skips_unchanged_files(self, mock_post, tmp_path):
+        """Test media sync uploads new files once and skips them on re-sync."""
+        (tmp_path / "hola.mp3").write_bytes(b"hola")
+        (tmp_path / "sub").mkdir()
+        (tmp_path / "sub" / "gato.jpg").write_bytes(b"gato")
+        (tmp_path / "notes.txt").write_bytes(b"ignored")
+        existing = {"gato.jpg": base64.b64encode(b"gato").decode("ascii")}
+
+        def handler(url, body):
+            if body["action"] == "retrieveMediaFile":
+                return existing.get(body["params"]["filename"], False)
+            return None
+
+        mock_post.side_effect = fake_server(handler)
+
+        result = json.loads(self.anki.sync_media(str(tmp_path), pattern="*.[mj]p*"))
+
+        assert result == {"files": 2, "uploaded": 1, "unchanged": 1, "failed": []}
+        stored = [
+            call[1]["json"]["params"]
+            for call in mock_post.call_args_list
+            if call[1]["json"]["action"] == "storeMediaFile"
+        ]
+        assert stored == [{"filename": "hola.mp3", "path": str(tmp_path / "hola.mp3")}]
+
+        mock_post.reset_mock()
+        result = json.loads(self.anki.sync_media(str(tmp_path), pattern="*.[mj]p*"))
+
+        assert result == {"files": 2, "uploaded": 0, "unchanged": 2, "failed": []}
+        mock_post.assert_not_called()
+
+    @patch("httpx.post")
+    def test_sync_media_reports_unreadable_files(self, mock_post, tmp_path):
+        """Test broken files and a failing process pool do not abort the sync."""
+        (tmp_path / "hola.mp3").write_bytes(b"hola")
+        (tmp_path / "broken.mp3").symlink_to(tmp_path / "missing.mp3")
+        mock_post.side_effect = fake_server(
+            lambda url, body: False if body["action"] == "retrieveMediaFile" else None
+        )
+
+        with (
+            patch.object(llm_tools_anki, "_PROCESS_HASH_MIN_FILES", 1),
+            patch.object(
+                llm_tools_anki,
+                "ProcessPoolExecutor",
+                side_effect=llm_tools_anki.BrokenProcessPool("no __main__ guard"),
+            ),
+        ):
+            result = json.loads(self.anki.sync_media(str(tmp_path), pattern="*.mp3"))
+
+        assert result["files"] == 2
+        assert result["uploaded"] == 1
+        assert [failure["file"] for failure in result["failed"]] == [
+            str(tmp_path / "broken.mp3")
+        ]
+
+    @patch("httpx.post")
+    def test_preview_notes(self, mock_post):
+        """Test notes are rendered locally with problems flagged."""
+        models = {
+            "Basic (and reversed card)": {
+                "modelFieldNames": ["Front", "Back"],
+                "modelTemplates": {
+                    "Card 1": {
+                        "Front": "{{Front}}",
+                        "Back": "{{FrontSide}}<hr id=answer>{{Back}}",
+                    },
+                    "Card 2": {
+                        "Front": "{{#Back}}{{Back}}{{/Back}}",
+                        "Back": "{{FrontSide}}<hr id=answer>{{Front}}",
+                    },
+                },
+            },
+            "Cloze": {
+                "modelFieldNames": ["Text", "Extra"],
+                "modelTemplates": {
+                    "Cloze": {
+                        "Front": "{{cloze:Text}}",
+                        "Back": "{{cloze:Text}}<br>{{Extra}}",
+                    }
+                },
+            },
+        }
+
+        mock_post.side_effect = fake_server(
+            lambda url, body: models[body["params"]["modelName"]][body["action"]]
+        )
+        notes = [
+            {
+                "modelName": "Basic (and reversed card)",
+                "fields": {"Front": "hola", "Back": ""},
+            },
+            {
+                "modelName": "Cloze",
+                "fields": {"Text": "{{c1::Madrid}} is in {{c2::Spain::country}}"},
+            },
+        ]
+
+        result = json.loads(self.anki.preview_notes(notes))
+
+        assert result[0]["ok"] is True
+        assert result[0]["problems"] == [
+            {"type": "empty_cards", "templates": ["Card 2"]}
+        ]
+        assert result[0]["cards"] == [
+            {
+                "template": "Card 1",
+                "question": "hola",
+                "answer": "hola<hr id=answer>",
+            }
+        ]
+        assert result[1]["ok"] is False
+        assert result[1]["problems"] == [
+            {"type": "missing_fields", "fields": ["Extra"]}
+        ]
+        assert [card["template"] for card in result[1]["cards"]] == [
+            "Cloze c1",
+            "Cloze c2",
+        ]
+        assert result[1]["cards"][1]["question"] == (
+            'Madrid is in <span class="cloze">[country]</span>'
+        )
+
+        calls = mock_post.call_count
+        self.anki.preview_notes(notes)
+        assert mock_post.call_count == calls
+
+        result = json.loads(
+            self.anki.preview_notes(
+                [{"modelName": "Cloze", "fields": {"Text": None, "Extra": None}}]
+            )
+        )
+        assert result[0]["problems"] == [
+            {"type": "empty_cards", "templates": ["Cloze"]},
+            {"type": "no_cards"},
+        ]
+
+    @patch("httpx.post")
+    def test_record_and_replay(self, mock_post, tmp_path):
+        """Test recorded traffic replays offline with identical results."""
+        recording = tmp_path / "session.jsonl"
+        mock_post.side_effect = [
+            json_response({"result": [1, 2], "error": None}),
+            httpx.HTTPError("Connection failed"),
+        ]
+
+        recorder = Anki(record_file=str(recording))
+        recorded = recorder.find_notes("deck:current")
+        recorded_error = recorder.get_deck_names()
+
+        entries = [json.loads(line) for line in recording.read_text().splitlines()]
+        assert [entry["service"] for entry in entries] == ["ankiconnect"] * 2
+        assert entries[0]["body"]["action"] == "findNotes"
+        assert entries[0]["response"] == {"result": [1, 2], "error": None}
+        assert entries[1]["error"] == "Connection failed"
+        assert "elapsed_ms" in entries[0]
+
+        mock_post.reset_mock()
+        replayer = Anki(replay_file=str(recording))
+
+        assert replayer.find_notes("deck:current") == recorded == "[1, 2]"
+        assert replayer.get_deck_names() == recorded_error
+        assert "No recorded response" in replayer.find_notes("deck:other")
+        mock_post.assert_not_called()
+
+    @patch("httpx.post")
+    def test_long_text_audio_is_chunked_and_cached(self, mock_post):
+        """Test long TTS input is synthesized per sentence and joined into one WAV."""
+
+        def handler(url, body):
+            buffer = io.BytesIO()
+            with wave.open(buffer, "wb") as writer:
+                writer.setnchannels(1)
+                writer.setsampwidth(2)
+                writer.setframerate(24000)
+                writer.writeframes(b"\x00\x01" * len(body["input"]["text"]))
+            return {"audioContent": base64.b64encode(buffer.getvalue()).decode("ascii")}
+
+        mock_post.side_effect = fake_server(handler)
+        self.anki.gemini_api_key = "test-key"
+        sentences = [f"Sentence {i} has" + " word" * 40 + "." for i in range(4)]
+
+        audio = self.anki._synthesize_speech(" ".join(sentences))
+
+        assert mock_post.call_count == 4
+        with wave.open(io.BytesIO(base64.b64decode(audio)), "rb") as reader:
+            assert reader.getnframes() == sum(len(text) for text in sentences)
+
+        sentences[2] = "An edited sentence has" + " word" * 60 + "."
+        self.anki._synthesize_speech(" ".join(sentences))
+
+        assert mock_post.call_count == 5
+        assert mock_post.call_args[1]["json"]["input"]["text"] == sentences[2]
+
+        # The cache lives on disk, so a new session reuses it
+        anki = Anki()
+        anki._tts_cache_dir = self.anki._tts_cache_dir
+        anki.gemini_api_key = "test-key"
+        assert anki._synthesize_speech(" ".join(sentences)) is not None
+        assert mock_post.call_count == 5
+
+    @patch("httpx.post")
+    def test_editing_short_sentence_resynthesizes_one_chunk(self, mock_post):
+        """Test a length change in one short sentence keeps the other chunks cached."""
+        mock_post.side_effect = fake_server(lambda url, body: {"audioContent": "QUJD"})
+        self.anki.gemini_api_key = "test-key"
+        sentences = [f"This is short sentence number {i}." for i in range(20)]
+        assert len(" ".join(sentences)) > 400
+
+        self.anki._synthesize_speech(" ".join(sentences))
+        assert mock_post.call_count == 20
+
+        sentences[0] = "This short sentence is now a little longer."
+        self.anki._synthesize_speech(" ".join(sentences))
+
+        assert mock_post.call_count == 21
+        assert mock_post.call_args[1]["json"]["input"]["text"] == sentences[0]
+
+    @patch("httpx.post")
+    def test_tts_cache_evicts_least_recently_used(self, mock_post):
+        """Test the TTS cache stays under its size bound, evicting old audio first."""
+        mock_post.side_effect = fake_server(lambda url, body: {"audioContent": "QUJD"})
+        self.anki.gemini_api_key = "test-key"
+        self.anki._tts_cache_max_bytes = 10
+        cache_dir = self.anki._tts_cache_dir
+
+        for i, text in enumerate(["one", "two", "three"]):
+            self.anki._synthesize_speech(text)
+            for path in cache_dir.iterdir():
+                if path.stat().st_mtime > 10**6:
+                    os.utime(path, (i, i))
+        self.anki._synthesize_speech("four")
+
+        assert mock_post.call_count == 4
+        assert sum(path.stat().st_size for path in cache_dir.iterdir()) <= 9
+        self.anki._synthesize_speech("two")
+        assert mock_post.call_count == 4
+        self.anki._synthesize_speech("one")
+        assert mock_post.call_count == 5
+
+        # A zero bound disables the cache
+        anki = Anki(tts_cache_mb=0)
+        anki._tts_cache_dir = cache_dir / "disabled"
+        anki.gemini_api_key = "test-key"
+        anki._synthesize_speech("two")
+        assert mock_post.call_count == 6
+        assert not anki._tts_cache_dir.exists()
+
+    def _notes_backend(self, notes, pages):
+        """Build an httpx.post side effect serving findNotes and paged notesInfo."""
+
+        def handler(url, body):
+            if body["action"] == "findNotes":
+                return [note["noteId"] for note in notes]
+            pages.append(body["params"]["notes"])
+            return [n for n in notes if n["noteId"] in body["params"]["notes"]]
+
+        return fake_server(handler)
+
+    @patch("httpx.post")
+    def test_export_jsonl(self, mock_post, tmp_path):
+        """Test notes are exported page by page with field projection."""
+        notes = [
+            {
+                "noteId": i,
+                "modelName": "Basic",
+                "tags": ["t"],
+                "fields": {
+                    "Front": {"value": f"q{i}", "order": 0},
+                    "Back": {"value": f"a{i}", "order": 1},
+                },
+            }
+            for i in range(5)
+        ]
+        pages = []
+        mock_post.side_effect = self._notes_backend(notes, pages)
+        output = tmp_path / "notes.jsonl"
+
+        result = json.loads(
+            self.anki.export(
+                "deck:*", str(output), fields=["Front"], include_tags=False, page_size=2
+            )
+        )
+
+        assert result == {"rows": 5, "file": str(output), "format": "jsonl"}
+        assert pages == [[0, 1], [2, 3], [4]]
+        rows = [json.loads(line) for line in output.read_text().splitlines()]
+        assert rows[4] == {"noteId": 4, "modelName": "Basic", "fields": {"Front": "q4"}}
+
+    @patch("httpx.post")
+    def test_export_cards_with_note_tags(self, mock_post, tmp_path):
+        """Test card exports take their tags from the cards' notes."""
+        cards = [
+            {
+                "cardId": 100 + i,
+                "note": 1,
+                "deckName": "Default",
+                "modelName": "Basic",
+                "interval": i,
+                "fields": {"Front": {"value": "q", "order": 0}},
+            }
+            for i in range(2)
+        ]
+        requests = []
+
+        def handler(url, body):
+            requests.append(body["action"])
+            if body["action"] == "findCards":
+                return [card["cardId"] for card in cards]
+            if body["action"] == "cardsInfo":
+                return cards
+            return [{"noteId": 1, "tags": ["verb"]}]
+
+        mock_post.side_effect = fake_server(handler)
+        output = tmp_path / "cards.jsonl"
+
+        result = json.loads(self.anki.export("deck:*", str(output), kind="cards"))
+
+        assert result["rows"] == 2
+        assert requests == ["findCards", "cardsInfo", "notesInfo"]
+        rows = [json.loads(line) for line in output.read_text().splitlines()]
+        assert rows[1]["cardId"] == 101
+        assert rows[1]["interval"] == 1
+        assert rows[1]["tags"] == ["verb"]
+        assert rows[1]["fields"] == {"Front": "q"}
+
+    @patch("httpx.post")
+    def test_export_parquet(self, mock_post, tmp_path):
+        """Test notes are exported to Parquet when pyarrow is installed."""
+        parquet = pytest.importorskip("pyarrow.parquet")
+        notes = [
+            {
+                "noteId": 1,
+                "modelName": "Basic",
+                "tags": ["a", "b"],
+                "fields": {"Front": {"value": "q", "order": 0}},
+            }
+        ]
+        mock_post.side_effect = self._notes_backend(notes, [])
+        output = tmp_path / "notes.parquet"
+
+        result = json.loads(self.anki.export("deck:*", str(output), "parquet"))
+
+        assert result["rows"] == 1
+        assert parquet.read_table(output).to_pylist() == [
+            {
+                "noteId": 1,
+                "modelName": "Basic",
+                "tags": ["a", "b"],
+                "fields": [("Front", "q")],
+            }
+        ]
+
+    @patch("httpx.post")
+    def test_changes_since(self, mock_post, tmp_path):
+        """Test the change feed reports added, modified, removed and deleted notes."""
+        cursor = tmp_path / "cursor.json"
+        state = {"notes": [1, 2, 3, 5]}
+        # Note 2 is deleted from the collection, note 5 only leaves the deck
+        mods = {1: 0, 3: time.time() + 3600, 5: 0}
+        queries = []
+
+        def handler(url, body):
+            params = body["params"]
+            if body["action"] == "findNotes":
+                queries.append(params["query"])
+                return state["notes"]
+            return [
+                {"noteId": i, "mod": mods[i]} if i in mods else {}
+                for i in params["notes"]
+            ]
+
+        mock_post.side_effect = fake_server(handler)
+
+        first = json.loads(self.anki.changes_since("deck:Spanish", str(cursor)))
+        assert first["added"] == [1, 2, 3, 5]
+        assert first["since"] is None
+
+        state["notes"] = [1, 3, 4]
+        second = json.loads(self.anki.changes_since("deck:Spanish", str(cursor)))
+
+        assert second["added"] == [4]
+        assert second["removed"] == [5]
+        assert second["deleted"] == [2]
+        assert second["modified"] == [3]
+        assert second["since"] == first["until"]
+        assert queries[-1] == "(deck:Spanish) edited:2"
+        assert json.loads(cursor.read_text())["note_ids"] == [1, 3, 4]
+
+        result = self.anki.changes_since("deck:French", str(cursor))
+        assert result.startswith("Error: cursor file")
+
+    @patch("httpx.post")
+    def test_changes_since_across_rollover(self, mock_post, tmp_path):
+        """Test an edit before Anki's day rollover is still found a few hours later."""
+        cursor = tmp_path / "cursor.json"
+        since = time.time() - 2 * 3600
+        cursor.write_text(
+            json.dumps(
+                {"query": "deck:Spanish", "timestamp": since, "note_ids": [1, 2]}
+            )
+        )
+        queries = []
+
+        def handler(url, body):
+            params = body["params"]
+            if body["action"] == "findNotes":
+                queries.append(params["query"])
+                return [1, 2]
+            mods = {1: since - 86400, 2: since + 3600}
+            return [{"noteId": i, "mod": mods[i]} for i in params["notes"]]
+
+        mock_post.side_effect = fake_server(handler)
+
+        result = json.loads(
+            self.anki.changes_since("deck:Spanish", str(cursor), include_reviewed=True)
+        )
+
+        assert queries[1] == "(deck:Spanish) edited:2"
+        assert queries[2] == "(deck:Spanish) rated:2"
+        assert result["modified"] == [2]
+        assert result["reviewed"] == [1, 2]
+
+    @patch("httpx.post")
+    def test_changes_since_edit_in_cursor_second(self, mock_post, tmp_path):
+        """Test an edit in the same whole second as the cursor is still reported."""
+        cursor = tmp_path / "cursor.json"
+        since = int(time.time()) - 0.25
+        cursor.write_text(
+            json.dumps({"query": "deck:Spanish", "timestamp": since, "note_ids": [1]})
+        )
+
+        def handler(url, body):
+            if body["action"] == "findNotes":
+                return [1]
+            return [{"noteId": 1, "mod": int(since)}]
+
+        mock_post.side_effect = fake_server(handler)
+
+        result = json.loads(self.anki.changes_since("deck:Spanish", str(cursor)))
+
+        assert result["modified"] == [1]
+
 
 class TestAnkiIntegration:
     """Integration tests for the Anki toolbox with LLM framework."""